@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+""" Benchmarks the AZ ranking pipeline against a stubbed EC2 client.
+
+Runs topology discovery, spot price history fetching (cold and warm) and
+scoring over synthetic price histories, and reports wall time, peak Python
+memory and EC2 API calls for each stage as JSON, one object per scenario.
+
+    python bench/bench_ranking.py --azs 10 200 --records 1000 1000000 -o bench.json
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from unittest import mock
+
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AZS_PER_REGION = 5
+INSTANCE_TYPES = ['c5.large', 'c5.xlarge', 'r4.8xlarge']
+PAGE_SIZE = 1000
+BID = 0.65
+COMPUTE_UNIT_WEIGHTS = {'vcpu': 1.0, 'memory_gib': 0.0, 'gpus': 0.0}
+
+
+class SyntheticWorld():
+    """ A made up set of regions, AZs and 7 days of spot price history, kept
+    as arrays so millions of records don't cost millions of dicts. """
+
+    def __init__(self, n_azs, n_records, seed=0):
+        rng = np.random.RandomState(seed)
+        n_regions = max(1, (n_azs + AZS_PER_REGION - 1) // AZS_PER_REGION)
+        self.regions = collections.OrderedDict()
+        for i in range(n_azs):
+            region = 'bench-{}'.format(i // AZS_PER_REGION)
+            self.regions.setdefault(region, []).append('{}{}'.format(region, chr(ord('a') + i % AZS_PER_REGION)))
+
+        now = time.time()
+        window = 7 * 24 * 60 * 60
+        per_region = max(1, n_records // n_regions)
+        self.history = {}
+        for region, azs in self.regions.items():
+            # newest first, like describe_spot_price_history
+            self.history[region] = {
+                'ts': (now - np.linspace(0, window, per_region)).astype(np.int64),
+                'price': rng.uniform(0.01, 1.0, per_region).astype(np.float32),
+                'az': rng.randint(0, len(azs), per_region),
+                'type': rng.randint(0, len(INSTANCE_TYPES), per_region),
+            }
+
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+
+class StubEC2Client():
+    """ Answers the EC2 calls the ranking pipeline makes, from a
+    SyntheticWorld, optionally sleeping `latency` seconds per call. """
+
+    def __init__(self, world, region, latency=0):
+        self.world = world
+        self.region = region
+        self.latency = latency
+        self.meta = types.SimpleNamespace(region_name=region)
+        self._selections = {}
+
+    def _call(self, name):
+        self.world.count(name)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def describe_regions(self):
+        self._call('describe_regions')
+        return {'Regions': [{'RegionName': region} for region in self.world.regions]}
+
+    def describe_availability_zones(self):
+        self._call('describe_availability_zones')
+        return {'AvailabilityZones': [{'ZoneName': az, 'State': 'available'}
+                                      for az in self.world.regions[self.region]]}
+
+    def describe_spot_price_history(self, StartTime=None, EndTime=None, InstanceTypes=None,
+                                    ProductDescriptions=None, AvailabilityZone=None,
+                                    NextToken=None, MaxResults=PAGE_SIZE, DryRun=False):
+        self._call('describe_spot_price_history')
+        azs = self.world.regions[self.region]
+        history = self.world.history[self.region]
+
+        key = (StartTime, tuple(InstanceTypes or ()), AvailabilityZone)
+        if key not in self._selections:
+            mask = history['ts'] >= int(StartTime.timestamp())
+            if InstanceTypes:
+                mask &= np.isin(history['type'], [INSTANCE_TYPES.index(t) for t in InstanceTypes])
+            if AvailabilityZone:
+                mask &= history['az'] == azs.index(AvailabilityZone)
+            self._selections[key] = np.nonzero(mask)[0]
+        selection = self._selections[key]
+
+        start = int(NextToken or 0)
+        page = selection[start:start + MaxResults]
+        records = [{'AvailabilityZone': azs[history['az'][i]],
+                    'InstanceType': INSTANCE_TYPES[history['type'][i]],
+                    'ProductDescription': 'Linux/UNIX',
+                    'SpotPrice': '{:.6f}'.format(history['price'][i]),
+                    'Timestamp': datetime.datetime.fromtimestamp(history['ts'][i], datetime.timezone.utc)}
+                   for i in page]
+        response = {'SpotPriceHistory': records}
+        if start + MaxResults < len(selection):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+
+def _import_pipeline():
+    """ Imports the repo the same way the labbox script does: as a package
+    named after its directory, with the repo itself on the path for configs. """
+    os.environ.setdefault('KEY_NAME', 'bench')
+    sys.path.insert(0, os.path.dirname(REPO_DIR))
+    sys.path.insert(0, REPO_DIR)
+    package = os.path.basename(REPO_DIR)
+    pricing_util = importlib.import_module(package + '.utils.pricing_util')
+    az_zone = importlib.import_module(package + '.utils.az_zone')
+    return pricing_util, az_zone
+
+
+def _stubbed_boto(world, latency):
+    """ Patches the client factory so every EC2 client the pipeline gets is a stub """
+    package = os.path.basename(REPO_DIR)
+
+    def get_client(service, region, **kwargs):
+        return StubEC2Client(world, region, latency)
+
+    return [mock.patch(package + '.utils.clients.get_client', get_client)]
+
+
+def _measure(world, stage, fn):
+    world.calls.clear()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'stage': stage,
+                    'wall_sec': round(wall, 4),
+                    'peak_mem_bytes': peak,
+                    'api_calls': dict(world.calls)}
+
+
+def run_scenario(pricing_util, az_zone, n_azs, n_records, latency=0):
+    world = SyntheticWorld(n_azs, n_records)
+    regions = list(world.regions)
+    stages = []
+    patches = _stubbed_boto(world, latency)
+    for patch in patches:
+        patch.start()
+    try:
+        with tempfile.TemporaryDirectory() as home, mock.patch.dict(os.environ, {'HOME': home}):
+
+            region_azs, stats = _measure(world, 'topology_cold',
+                                         lambda: pricing_util.load_region_AZ_dict(regions))
+            stages.append(stats)
+            _, stats = _measure(world, 'topology_warm',
+                                lambda: pricing_util.load_region_AZ_dict(regions))
+            stages.append(stats)
+
+            azs = [az_zone.AZZone(region, az) for region, names in region_azs.items() for az in names]
+            for stage in ['history_cold', 'history_warm']:
+                _, stats = _measure(world, stage,
+                                    lambda: pricing_util.collect_spot_pricing(
+                                        azs, INSTANCE_TYPES, deadline=None, max_age=0))
+                stages.append(stats)
+
+            units = az_zone.instance_types_util.compute_units_by_type(
+                INSTANCE_TYPES, COMPUTE_UNIT_WEIGHTS)
+            candidates = [c for az in azs for c in az.candidates(units)]
+
+            # The scalar path gets series of its own, whose stats haven't been
+            # computed yet, so it pays for them like a real ranking would
+            scalar_candidates = [
+                az_zone.Candidate(c.az, c.instance_type,
+                                  az_zone.PriceSeries(c.price_series.timestamps,
+                                                      c.price_series.prices),
+                                  c.units)
+                for c in candidates]
+
+            def score_scalar():
+                for c in scalar_candidates:
+                    c.calculate_score(BID)
+
+            _, stats = _measure(world, 'score_scalar', score_scalar)
+            stages.append(stats)
+            _, stats = _measure(world, 'score_vectorized',
+                                lambda: az_zone.score_candidates(candidates, BID))
+            stages.append(stats)
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    return {'azs': n_azs,
+            'records': n_records,
+            'regions': len(regions),
+            'candidates': len(candidates),
+            'latency_sec': latency,
+            'stages': stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--azs', type=int, nargs='+', default=[10, 50, 200],
+                        help='Numbers of AZs to benchmark')
+    parser.add_argument('--records', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='Numbers of price history records to benchmark')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds each stubbed EC2 call takes')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write results to this file as JSON, instead of stdout')
+    args = parser.parse_args()
+
+    pricing_util, az_zone = _import_pipeline()
+    results = []
+    for n_azs in args.azs:
+        for n_records in args.records:
+            print(">> {} AZs, {} records".format(n_azs, n_records), file=sys.stderr)
+            # keep the pipeline's own progress output out of the JSON
+            with contextlib.redirect_stdout(sys.stderr):
+                results.append(run_scenario(pricing_util, az_zone, n_azs, n_records, args.latency))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
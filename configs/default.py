@@ -2,8 +2,26 @@ import os
 # =============== Default configs ==================
 AWS_REGIONS = ['us-east-1', 'us-west-2', 'us-west-1', 'eu-west-1', 'eu-central-1', 'ap-southeast-1',
                'ap-northeast-1', 'ap-northeast-2', 'ap-southeast-2', 'sa-east-1']
+# Set AWS_REGIONS to None to rank every region your account can use.
 AZ_PICKLE_EXPIRE_TIME_DAYS = 30
 SPOT_PRICING_PICKLE_EXPIRE_SEC = 30 * 60
+# Spot pricing is fetched for all regions in parallel. This is how long we wait
+# for all of them before ranking.
+PRICING_DEADLINE_SEC = 30
+# Stop paging through an AZ's spot price history once this many records are in.
+# None scores on the full 7 day window.
+SPOT_PRICING_MAX_SAMPLES = None
+# Instance types are ranked on price per unit of compute. A unit is this
+# weighted sum of an instance type's vCPUs, memory and GPUs.
+COMPUTE_UNIT_WEIGHTS = {'vcpu': 1.0, 'memory_gib': 0.0, 'gpus': 0.0}
+# Every EC2 call goes through a per-region rate limiter. It starts at (and never
+# exceeds) this many requests a second, allows bursts of this size, and halves
+# its rate when AWS throttles us.
+EC2_MAX_REQUESTS_PER_SEC = 20
+EC2_REQUEST_BURST = 50
+# Throttled calls are retried with backoff, up to this many retries in total
+# across all regions. Successful calls slowly earn retries back.
+EC2_RETRY_BUDGET = 100
 
 
 # =============== Personal config ==================
@@ -13,8 +31,16 @@ KEY_NAME = os.environ["KEY_NAME"]
 SECURITY_GROUP_ID = ''
 SECURITY_GROUP = ''
 AMI_ID = ''
+# The AMI is looked up by AMI_NAME among the images owned by these accounts
+# ('self', an account ID, 'amazon'...). None searches every visible image.
+AMI_OWNERS = ['self']
+# How long an AMI's ID is remembered, per region, before asking AWS again
+AMI_CACHE_EXPIRE_SEC = 24 * 60 * 60
 INSTANCE_TYPES = ['g2.2xlarge']
 BID = 0.20
+# If a spot request fails, it's retried in the next best availability zone
+# whose current price is at or under this. None means BID.
+MAX_FALLBACK_PRICE = None
 SSH_USER_NAME = 'ubuntu'
 QTY_INSTANCES = 1
 SERVER_TIMEOUT = 60 * 5
@@ -25,3 +51,25 @@ OPEN_IN_BROWSER = True
 OPEN_SSH = True
 ADD_TO_ANSIBLE_HOSTS = True
 RUN_ANSIBLE = True
+# How code is shipped to instances: 'archive' uploads a tarball of the whole
+# directory every time, 'content' uploads only files S3_BUCKET doesn't have yet
+CODE_SHIPPING = 'archive'
+# How 'archive' shipping compresses: 'zstd' (multi-threaded), 'pigz' (parallel
+# gzip), 'gzip', 'none', or 'auto' to pick from a sample of the directory.
+# ARCHIVE_LEVEL None uses the codec's default level; levels out of a codec's
+# range are clamped to it.
+ARCHIVE_CODEC = 'auto'
+ARCHIVE_LEVEL = None
+# Send S3 requests here instead of to AWS, e.g. to test against a local S3
+# compatible server. None means AWS.
+S3_ENDPOINT_URL = None
+# How many launched instances to set up (wait for, copy code to...) at once
+POST_LAUNCH_PARALLELISM = 8
+# Run a watcher on each instance that pushes OUTPUT_DIR to S3_BUCKET when AWS
+# gives notice that it's reclaiming the instance. It also pushes every
+# CHECKPOINT_INTERVAL_SEC seconds (None to only push on notice). Off by
+# default, since the instance needs the aws cli and an instance role that can
+# write to S3_BUCKET.
+WATCH_FOR_INTERRUPTIONS = False
+CHECKPOINT_INTERVAL_SEC = 10 * 60
+INSTANCE_METADATA_URL = 'http://169.254.169.254'
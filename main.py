@@ -1,10 +1,10 @@
 import os
 import click
-import glob
 import json
 import subprocess
-import boto3
-import dill as pickle
+import contextlib
+import time
+from concurrent import futures
 
 from os.path import expanduser
 import fabric
@@ -22,9 +22,18 @@ def _open_in_editor(path):
     subprocess.call([editor, path])
 
 from .utils import pricing_util
-from .utils.aws_spot_instance import AWSSpotInstance, from_json
-from .utils.aws_spot_exception import SpotConstraintException
+from .utils.aws_spot_instance import AWSSpotInstance, from_registry
+from .utils.poller import SpotRequestPoller
+from .utils import readiness
+from .utils import pipeline
 from .utils import paths
+from .utils import amis
+from .utils import registry
+from .utils import fleet
+from .utils import code_sync
+from .utils import archive
+from .utils import compression
+from .utils import excludes
 
 
 def _highlight(x, fg='green'):
@@ -32,115 +41,133 @@ def _highlight(x, fg='green'):
         x = json.dumps(x, sort_keys=True, indent=2)
     click.secho(x, fg=fg)
 
-def upload_archive(fpath, name, s3_bucket, skip_archive, exclude_file):
-    import hashlib, os.path as osp, subprocess, tempfile, uuid, sys
-    # Archive this package
-    thisfile_dir = osp.dirname(osp.abspath(fpath))
-    pkg_dir = osp.abspath(osp.join(thisfile_dir, '.'))
-    _highlight("Running tar from: {}".format(pkg_dir))
-#    assert osp.abspath(__file__) == osp.join(pkg_parent_dir, pkg_subdir, 'deploy2.py'), 'You moved me!'
-
-    # Run tar
-#    tmpdir = tempfile.TemporaryDirectory()
-    tmpdir = "/tmp"
-    if skip_archive:
-        _highlight("Skipping archiving, using latest code...")
-        # use latest archive
-        archives = glob.glob(os.path.join(tmpdir, 'crl_*'))
-        if len(archives) == 0:
-            _highlight("No existing archives found in {}...".format(tmpdir))
-            input("\nPress return to continue and create a new code archive.")
-            upload_archive(fpath, name, s3_bucket, False, exclude_file=exclude_file)
-            return
-        latest_file = max(archives, key=os.path.getctime)
-        local_archive_path = latest_file
-    else:
-        local_archive_path = osp.join(tmpdir, 'aws_spot_{}.tar.gz'.format(uuid.uuid4()))
-        tar_cmd = ["tar", "-vzcf", local_archive_path]
-        if exclude_file is not None:
-            tar_cmd += ["-X", "{}".format(exclude_file)]
-        # for pattern in archive_excludes:
-        #     tar_cmd += ["--exclude", '{}'.format(pattern)]
-        tar_cmd += ['.']
-        _highlight("TAR CMD: {}".format(" ".join(tar_cmd)))
-
-        if sys.platform == 'darwin':
-            # Prevent Mac tar from adding ._* files
-            env = os.environ.copy()
-            env['COPYFILE_DISABLE'] = '1'
-            subprocess.check_call(tar_cmd, env=env)
-        else:
-            subprocess.check_call(tar_cmd)
-
-    # Construct remote path to place the archive on S3
-    with open(local_archive_path, 'rb') as f:
-        archive_hash = hashlib.sha224(f.read()).hexdigest()
-    remote_archive_path = '{}/{}_{}.tar.gz'.format(s3_bucket, name, archive_hash)
-
-    # Upload
-    upload_cmd = ["aws", "s3", "cp", local_archive_path, remote_archive_path]
-    _highlight(" ".join(upload_cmd))
-    subprocess.check_call(upload_cmd)
-
-    # presign_cmd = ["aws", "s3", "presign", remote_archive_path, "--expires-in", str(60 * 60 * 24 * 30)]
-    presign_cmd = ["aws", "s3", "presign", remote_archive_path, "--expires-in", str(60 * 60 * 24)]
-    _highlight(" ".join(presign_cmd))
-    remote_url = subprocess.check_output(presign_cmd).decode("utf-8").strip()
-    return remote_url
-
-def _make_download_script(code_url):
+def _make_download_script(code_url, codec):
+    """Streams the archive from S3 straight into /home/rstudio/research. The
+    archive carries the right owner and permissions for every file, so there's
+    no temporary copy and no recursive chown/chmod afterwards."""
     print(">> Downloading code from {}".format(code_url))
     return """
-    set -x
-    cd ~
-    wget -S '{code_url}' -O code.tar.gz
-    mkdir research
-    cd research
-    tar xvaf ../code.tar.gz
-    cd ~
-    rm code.tar.gz
+    set -ex -o pipefail
+    {install}
+    sudo usermod -aG ubuntu rstudio
+    sudo mkdir -p /home/rstudio/research
+    sudo chown rstudio:ubuntu /home/rstudio/research
+    sudo chmod g+rwx /home/rstudio /home/rstudio/research
+    wget -qO- '{code_url}' | {decompress} | sudo tar -x --same-owner -p -C /home/rstudio/research -f -
+    """.format(code_url=code_url, install=compression.install_command(codec),
+               decompress=codec.decompress)
+
+def _util_source(name):
+    """Returns the source of one of the standalone scripts in utils/, to copy
+    to an instance"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "utils", "{}.py".format(name)), "r") as f:
+        return f.read()
+
+def _make_restore_script(manifest_url):
+    print(">> Restoring code from manifest {}".format(manifest_url))
+    return """
+    set -ex
+    cat > ~/labbox_restore_tree.py <<'LABBOX_EOF'
+{restore_tree}
+LABBOX_EOF
     sudo mkdir -p /home/rstudio/research
-    sudo mv research/* /home/rstudio/research/
+    sudo python3 ~/labbox_restore_tree.py '{manifest_url}' /home/rstudio/research --cache-dir ~/.labbox_blobs
     sudo usermod -aG ubuntu rstudio
     sudo chmod -R g+rwx /home/rstudio
     sudo chown -R rstudio:ubuntu /home/rstudio/research
-    """.format(code_url=code_url)
-
-def get_ami_id_from_name_and_region(name, region):
-    boto3.setup_default_session(region_name=region)
-    client = boto3.client('ec2')
-    amis = client.describe_images()['Images']
-    amis = [ami for ami in amis if 'Name' in ami.keys()]
-    matches = [ami for ami in amis if ami['Name'] == name]
-    if len(matches) > 0:
-        return matches[0]['ImageId']
-    else:
-        return None
-
+    """.format(restore_tree=_util_source("restore_tree"), manifest_url=manifest_url)
+
+def ship_code(uconf, name, exclude_file):
+    """Uploads the current directory the way the config's CODE_SHIPPING asks,
+    and returns the script that installs it on an instance."""
+    if uconf.CODE_SHIPPING == 'content':
+        manifest_url = code_sync.ship_tree(os.getcwd(), name, uconf.S3_BUCKET, exclude_file,
+                                           uconf.S3_ENDPOINT_URL)
+        return _make_restore_script(manifest_url)
+    _highlight("Archiving and uploading {}".format(os.getcwd()))
+    code_url, codec = archive.upload_archive(os.getcwd(), name, uconf.S3_BUCKET, exclude_file,
+                                             uconf.S3_ENDPOINT_URL, uconf.ARCHIVE_CODEC,
+                                             uconf.ARCHIVE_LEVEL)
+    return _make_download_script(code_url, codec)
 
 def launch_instances(qty, config_name):
-    """Launches QTY instances and returns the instance objects."""
+    """Launches QTY instances and returns the instance objects.
+
+    All spot requests are submitted up front and then polled together, so
+    launching a fleet takes about as long as launching one instance. Requests
+    that fail (e.g. for lack of capacity) are retried in the next best
+    availability zone, as long as its current price is under
+    MAX_FALLBACK_PRICE (and bidding that much there), until QTY instances are
+    up or we run out of zones.
+    """
     uconf = paths._load_config(config_name)
-    best_az = pricing_util.get_best_az()
+    # Look up the AMI in every region while the zones are being ranked
+    regions = list(pricing_util.load_region_AZ_dict(uconf.AWS_REGIONS,
+                                                    uconf.AZ_PICKLE_EXPIRE_TIME_DAYS))
+    prefetch = futures.ThreadPoolExecutor(max_workers=1)
+    prefetched = prefetch.submit(amis.prefetch_ami_ids, uconf.AMI_NAME, regions,
+                                 uconf.AMI_OWNERS, uconf.AMI_CACHE_EXPIRE_SEC)
+    prefetch.shutdown(wait=False)
+    candidates = pricing_util.rank_candidates(uconf)
+    pricing_util.print_candidates(candidates)
+    max_price = uconf.MAX_FALLBACK_PRICE if uconf.MAX_FALLBACK_PRICE is not None else uconf.BID
+    candidates = pricing_util.launchable_candidates(candidates, max_price)
+
     launched_instances = []
-    print("Best availability zone:", best_az.name)
-    print("getting AMI named {} from region {}".format(uconf.AMI_NAME, best_az.region))
-    ami_id = get_ami_id_from_name_and_region(uconf.AMI_NAME, best_az.region)
-    if ami_id is None:
-        print("No AMI Match. Exiting...")
-    else:
-        print("Found matching AMI with ID {}".format(ami_id))
-    for idx in range(qty):
-        print('>> Launching instance #{}'.format(idx))
-        si = AWSSpotInstance(best_az.region, best_az.name, uconf.INSTANCE_TYPES[0], ami_id, uconf.BID, config_name)
-        si.request_instance()
-        try:
-            si.get_ip()
-        except SpotConstraintException as e:
-            print(">> ", e.message)
-            si.cancel_spot_request()
-            continue
-        launched_instances.append(si)
+    # every instance requested so far, so none are left running (and
+    # billing) if anything goes wrong before we return them
+    requested = []
+    ami_ids = prefetched.result()
+    try:
+        for candidate in candidates:
+            needed = qty - len(launched_instances)
+            if needed <= 0:
+                break
+            print("Launching {} instances in availability zone:".format(needed),
+                  candidate.az_name, candidate.instance_type)
+
+            if candidate.region not in ami_ids:
+                print("getting AMI named {} from region {}".format(uconf.AMI_NAME, candidate.region))
+                ami_ids[candidate.region] = amis.get_ami_id(uconf.AMI_NAME, candidate.region,
+                                                            uconf.AMI_OWNERS,
+                                                            uconf.AMI_CACHE_EXPIRE_SEC)
+            ami_id = ami_ids[candidate.region]
+            if ami_id is None:
+                print("No AMI Match in {}, trying the next availability zone...".format(candidate.region))
+                continue
+            print("Found matching AMI with ID {}".format(ami_id))
+
+            # Zones under BID are bid BID as usual; fallback zones are only
+            # worth trying with a bid that can actually win them
+            bid = uconf.BID if candidate.current_price <= uconf.BID else max_price
+            batch = []
+            for idx in range(needed):
+                print('>> Launching instance #{}'.format(len(launched_instances) + idx))
+                si = AWSSpotInstance(candidate.region, candidate.az_name, candidate.instance_type,
+                                     ami_id, bid, config_name)
+                requested.append(si)
+                si.request_instance()
+                batch.append(si)
+
+            ready, failed = SpotRequestPoller(batch).wait()
+            launched_instances += ready
+            for si, reason in failed.items():
+                print(">> ", reason)
+                si.abandon()
+    except BaseException:
+        _highlight("Launch failed, cancelling {} spot requests".format(len(requested)), fg='red')
+        for si in requested:
+            try:
+                si.abandon()
+            except Exception as e:
+                _highlight("Couldn't clean up request {} (instance {}): {}".format(
+                    si.spot_instance_request_id, si.instance_id, e), fg='red')
+        raise
+
+    if len(launched_instances) < qty:
+        print(">> Only launched {} of {} instances: no more availability zones under ${}".format(
+            len(launched_instances), qty, max_price))
 
     return launched_instances
 
@@ -225,6 +252,120 @@ def _run_ansible(conf, tags):
                                                                     ans_path,
                                                                     tags))
 
+def _run_remote_script(ip, script, uconf):
+    """Runs a shell script on the instance over ssh. Unlike fabric's global
+    env, this is safe to call from many threads at once."""
+    cmd = ["ssh",
+           "-i", expanduser(uconf.PATH_TO_KEY),
+           "-o", "StrictHostKeyChecking=no",
+           "-o", "BatchMode=yes",
+           "{}@{}".format(uconf.SSH_USER_NAME, ip),
+           "bash -s"]
+    proc = subprocess.run(cmd, input=script.encode("utf-8"),
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        print(proc.stdout.decode("utf-8", "replace"))
+        raise Exception("Remote script exited with status {}".format(proc.returncode))
+    return proc.stdout.decode("utf-8", "replace")
+
+def _open_ports(instances):
+    """Opens ports 80 and 22 to every instance. Returns {instance: exception}
+    for the ones that failed."""
+    failures = {}
+    for si in instances:
+        try:
+            si.open_http_and_ssh()
+        except Exception as e:
+            failures[si] = e
+    return failures
+
+def _probe_ports(instances, ports, timeout):
+    """Waits for the ports on every instance in one go, so the whole fleet is
+    probed at once rather than POST_LAUNCH_PARALLELISM instances at a time.
+    Returns {(instance, port): ProbeResult}."""
+    targets = [(si, port) for si in instances for port in ports]
+    if not targets:
+        return {}
+    results = readiness.probe_hosts([(si.ip, port, si.launched_at) for si, port in targets],
+                                    timeout)
+    for result in results:
+        print(">> ", result)
+    return dict(zip(targets, results))
+
+def _raise_failure(failures, si):
+    if si in failures:
+        raise failures[si]
+
+def _check_port(probes, si, port):
+    result = probes[(si, port)]
+    if not result.ready:
+        raise Exception("port {} didn't come up: {}".format(port, result.error))
+
+def _checkpoint_url(uconf, si):
+    """Where an instance's output directory is pushed when it's interrupted"""
+    return "{}/{}/checkpoints/{}/{}".format(uconf.S3_BUCKET.rstrip("/"), si.config_name,
+                                            si.instance_id,
+                                            os.path.basename(os.path.normpath(uconf.OUTPUT_DIR)))
+
+def _make_watcher_script(uconf, si):
+    """Copies utils/interruption.py to the instance and starts it in the
+    background, watching the output directory.
+
+    The watcher only logs to the instance, so before starting it the script
+    checks that the instance can push checkpoints at all (the aws cli,
+    credentials, e.g. from an instance role, and write access to the
+    checkpoint URL), and fails the stage if it can't."""
+    checkpoint_url = _checkpoint_url(uconf, si)
+    args = ["/home/rstudio/research/{}".format(uconf.OUTPUT_DIR),
+            checkpoint_url,
+            "--metadata-url", uconf.INSTANCE_METADATA_URL]
+    if uconf.CHECKPOINT_INTERVAL_SEC:
+        args += ["--checkpoint-interval", str(uconf.CHECKPOINT_INTERVAL_SEC)]
+    return """
+    set -e
+    command -v aws >/dev/null || {{ echo "The aws cli isn't installed" >&2; exit 1; }}
+    aws sts get-caller-identity >/dev/null || {{ echo "No AWS credentials (attach an instance role)" >&2; exit 1; }}
+    echo ok | aws s3 cp - '{check_url}' >/dev/null || {{ echo "Can't write checkpoints to {url}" >&2; exit 1; }}
+    aws s3 rm '{check_url}' >/dev/null
+    cat > ~/labbox_interruption.py <<'LABBOX_EOF'
+{watcher}
+LABBOX_EOF
+    nohup python3 ~/labbox_interruption.py {args} > ~/labbox_interruption.log 2>&1 < /dev/null &
+    """.format(watcher=_util_source("interruption"), args=" ".join("'{}'".format(a) for a in args),
+               url=checkpoint_url, check_url="{}/.labbox_write_check".format(checkpoint_url))
+
+def _wait_ports(uconf):
+    ports = []
+    if uconf.WAIT_FOR_HTTP:
+        ports.append(80)
+    if uconf.WAIT_FOR_SSH:
+        ports.append(22)
+    return ports
+
+def _post_launch_stages(uconf, code_script, port_failures, probes):
+    """Returns the pipeline stages to run on each launched instance.
+
+    Ports are opened and probed for the whole fleet before the pipelines run
+    (see _open_ports and _probe_ports); their stages just report the outcome
+    for each instance, so failures are recorded like any other stage's.
+    """
+    stages = []
+    if uconf.WAIT_FOR_HTTP or uconf.WAIT_FOR_SSH:
+        stages.append(pipeline.Stage("open ports", lambda si: _raise_failure(port_failures, si)))
+    if uconf.WAIT_FOR_HTTP:
+        stages.append(pipeline.Stage("wait for http", lambda si: _check_port(probes, si, 80)))
+    if uconf.WAIT_FOR_SSH:
+        stages.append(pipeline.Stage("wait for ssh", lambda si: _check_port(probes, si, 22)))
+    if uconf.COPY_CODE:
+        stages.append(pipeline.Stage("copy code",
+                                     lambda si: _run_remote_script(si.ip, code_script, uconf)))
+    if uconf.WATCH_FOR_INTERRUPTIONS:
+        stages.append(pipeline.Stage("interruption watcher",
+                                     lambda si: _run_remote_script(si.ip, _make_watcher_script(uconf, si), uconf)))
+    if uconf.ADD_TO_ANSIBLE_HOSTS:
+        stages.append(pipeline.Stage("ansible hosts", lambda si: si.add_to_ansible_hosts()))
+    return stages
+
 @click.command()
 @click.argument("conf", required=True)
 def from_config(conf):
@@ -236,42 +377,51 @@ def from_config(conf):
     uconf = paths._load_config(conf)
     _highlight("Using configuration {}".format(conf))
 
-    if os.path.exists(".exclude"):
-        with open(".exclude", 'r') as f:
-            to_exclude = f.read().split("\n")
-            exclude_file=".exclude"
-    else:
-        to_exclude = []
-        exclude_file=None
+    exclude_file = ".exclude" if os.path.exists(".exclude") else None
+    matcher = excludes.ExcludeMatcher.from_file(exclude_file)
 
     _highlight("Excluding these patterns from archive:")
-    print(", ".join(to_exclude))
+    print(", ".join(matcher.patterns))
+    _highlight("Uploading {}".format(excludes.format_summary(*excludes.summarize(".", matcher))))
     if not click.confirm('Do you want to continue? This will upload your current directory to the instance.'):
         return
-    code_url = upload_archive(os.getcwd(), conf, uconf.S3_BUCKET, skip_archive=False, exclude_file=exclude_file)
+    code_script = ship_code(uconf, conf, exclude_file)
 
     #importlib.import_module(conf)
     #uconf = importlib.import_module(conf)
     #_load_module_from_path("uconf", path)
     instances = launch_instances(uconf.QTY_INSTANCES, conf)
 
-    for n, si in enumerate(instances):
-        if uconf.WAIT_FOR_HTTP:
-            si.wait_for_http()
-            si.serialize(n)
-        if uconf.WAIT_FOR_SSH:
-            si.wait_for_ssh()
-        if uconf.COPY_CODE:
-            env.key_filename = expanduser(uconf.PATH_TO_KEY)
-            env.user = 'ubuntu'
-            with settings(host_string=si.ip):
-                fabric.operations.run(_make_download_script(code_url))
+    # Number them after any instances of this config that are already
+    # recorded, so those keep their numbers
+    first = registry.InstanceRegistry().next_number(conf)
+    numbers = dict((si, n) for n, si in enumerate(instances, first))
+    for si, n in numbers.items():
+        si.register(n, 'running')
+
+    port_failures = _open_ports(instances) if _wait_ports(uconf) else {}
+    probes = _probe_ports([si for si in instances if si not in port_failures],
+                          _wait_ports(uconf), uconf.SERVER_TIMEOUT)
+
+    # Set every instance up concurrently, so one slow host doesn't hold up
+    # the rest
+    run = pipeline.run_pipelines(instances,
+                                 _post_launch_stages(uconf, code_script, port_failures, probes),
+                                 uconf.POST_LAUNCH_PARALLELISM,
+                                 label=lambda si: si.ip)
+    run.print_summary()
+    instance_registry = registry.InstanceRegistry()
+    for si in run.succeeded:
+        instance_registry.update(conf, numbers[si], status='ready')
+    for si, (stage, e) in run.failed.items():
+        instance_registry.update(conf, numbers[si], status='setup failed')
+        _highlight("{} failed at '{}': {}".format(si.ip, stage, e), fg='red')
+
+    for si in run.succeeded:
         if uconf.OPEN_IN_BROWSER:
             si.open_in_browser()
         if uconf.OPEN_SSH:
              si.open_ssh_term()
-        if uconf.ADD_TO_ANSIBLE_HOSTS:
-            si.add_to_ansible_hosts()
 
     if uconf.RUN_ANSIBLE:
         _run_ansible(conf, ["configuration"])
@@ -294,8 +444,140 @@ def ansible():
     """
     pass
 
+@click.group()
+def prices():
+    """Keep the local spot price store up to date
+    """
+    pass
+
+@click.command()
+@click.argument("conf", required=False, default=None)
+@click.option("--interval", type=int, default=None,
+              help="""Seconds between refreshes. Defaults to half of the
+              configuration's SPOT_PRICING_PICKLE_EXPIRE_SEC, so launches
+              always find fresh prices.""")
+def watch(conf, interval):
+    """Refreshes spot prices for a configuration's instance types on an
+    interval, so `launch` can rank availability zones without waiting on AWS.
+    Uses the default configuration if CONF isn't given.
+    """
+    if conf is None:
+        uconf = pricing_util.uconf
+    else:
+        uconf = paths._load_config(conf)
+    if interval is None:
+        interval = uconf.SPOT_PRICING_PICKLE_EXPIRE_SEC // 2
+    _highlight("Refreshing spot prices for {} every {}s".format(
+        ", ".join(uconf.INSTANCE_TYPES), interval))
+    pricing_util.watch_prices(uconf, interval)
+
+@click.group()
+def instances():
+    """Keep track of launched instances
+    """
+    pass
+
+@click.command("ls")
+@click.argument("conf", required=False, default=None)
+def ls_instances(conf):
+    """Lists the instances we've launched (for one configuration, if CONF is
+    given), from the local registry. Doesn't ask AWS, so states may be stale.
+    """
+    records = registry.InstanceRegistry().instances(conf)
+    if not records:
+        print("No instances recorded.")
+        return
+    print("{:<20} {:>3} {:<15} {:<16} {:<14} {:<20} {}".format(
+        "config", "n", "region", "az", "type", "instance", "ip / status"))
+    for r in records:
+        print("{:<20} {:>3} {:<15} {:<16} {:<14} {:<20} {} / {}".format(
+            r['config_name'], r['n'], r['region'], r['az_zone'], r['instance_type'],
+            r['instance_id'] or '-', r['ip'] or '-', r['status']))
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "-"
+    hours, rest = divmod(int(seconds), 3600)
+    return "{}h{:02d}m".format(hours, rest // 60)
+
+@click.command()
+@click.argument("conf", required=False, default=None)
+def status(conf):
+    """Asks AWS what the instances we've launched (for one configuration, if
+    CONF is given) are up to, and what they've cost so far. Updates the local
+    registry with what it finds.
+    """
+    records = registry.InstanceRegistry().instances(conf)
+    if not records:
+        print("No instances recorded.")
+        return
+    start = time.time()
+    statuses = fleet.refresh_fleet(records)
+    fleet.update_registry(statuses)
+
+    print("{:<20} {:>3} {:<16} {:<14} {:<16} {:<28} {:>8} {:>9} {:>8}".format(
+        "config", "n", "az", "type", "ip", "state", "uptime", "$/hour", "cost"))
+    total = 0.0
+    for s in statuses:
+        state = s.state or s.error or "unknown"
+        if s.spot_status and s.spot_status != 'fulfilled':
+            state = "{} ({})".format(state, s.spot_status)
+        total += s.cost or 0
+        print("{:<20} {:>3} {:<16} {:<14} {:<16} {:<28} {:>8} {:>9} {:>8}".format(
+            s.record['config_name'], s.record['n'], s.record['az_zone'],
+            s.record['instance_type'], s.ip or '-', state,
+            _format_duration(s.uptime),
+            "-" if s.spot_price is None else "{:.4f}".format(s.spot_price),
+            "-" if s.cost is None else "{:.2f}".format(s.cost)))
+    print(">> Running instances have cost about ${:.2f} so far (refreshed in {:.1f}s)".format(
+        total, time.time() - start))
+
+def _pull_output(uconf, ip):
+    """Copies the instance's output directory into the local one"""
+    cmd = ["rsync", "-avzO", "--no-owner", "--no-perms",
+           "-e", 'ssh -i {} -o StrictHostKeyChecking=no'.format(expanduser(uconf.PATH_TO_KEY)),
+           "{}@{}:/home/rstudio/research/{}/".format(uconf.SSH_USER_NAME, ip,
+                                                     uconf.OUTPUT_DIR.rstrip("/")),
+           "{}/".format(uconf.OUTPUT_DIR.rstrip("/"))]
+    _highlight("Pulling output from {}...".format(ip))
+    return subprocess.call(cmd)
+
+@click.command("watch")
+@click.argument("conf", required=False, default=None)
+@click.option("--interval", type=int, default=30,
+              help="Seconds between checks")
+def watch_instances(conf, interval):
+    """Watches the instances we've launched (for one configuration, if CONF
+    is given) for spot interruptions. As soon as AWS marks one for
+    termination, its output directory is pulled into the local one. Run this
+    from your project root.
+    """
+    instance_registry = registry.InstanceRegistry()
+    pulled = set()
+    while True:
+        records = [r for r in instance_registry.instances(conf)
+                   if r['status'] not in fleet.GONE_STATES]
+        if not records:
+            print(">> No running instances to watch.")
+            return
+        statuses = fleet.refresh_fleet(records)
+        fleet.update_registry(statuses, instance_registry)
+        for s in statuses:
+            key = (s.record['config_name'], s.record['n'])
+            if s.interrupted and s.ip and key not in pulled:
+                _highlight("{} {} is being interrupted ({})".format(
+                    s.record['config_name'], s.record['n'], s.spot_status), fg='red')
+                _pull_output(paths._load_config(s.record['config_name']), s.ip)
+                pulled.add(key)
+        time.sleep(interval)
+
 launch.add_command(from_config)
 
+instances.add_command(ls_instances)
+instances.add_command(watch_instances)
+
+prices.add_command(watch)
+
 config.add_command(ls)
 config.add_command(new)
 config.add_command(edit)
@@ -309,15 +591,11 @@ ansible.add_command(edit_ansible)
 @click.pass_context
 def run(ctx, conf, n):
     print(conf)
-    instance = from_json(conf, n)
+    instance = from_registry(conf, n)
     ctx.obj['instance'] = instance
     ctx.obj['conf'] = conf
     pass
 
-def ls(conf):
-    with open(paths._custom_path() + "/{}.pickle".format(conf), "rb") as f:
-        instances = pickle.load(f)
-    print(["{}: {}".format(n, instance.ip) for n, instance in enumerate(instances)])
 
 @click.command()
 @click.pass_context
@@ -339,16 +617,8 @@ def upload_code(ctx):
         exclude_file = ".exclude"
     else:
         exclude_file = None
-    code_url = upload_archive(os.getcwd(),
-                              conf,
-                              uconf.S3_BUCKET,
-                              skip_archive=False,
-                              exclude_file=exclude_file)
-    env.key_filename = expanduser(uconf.PATH_TO_KEY)
-    env.user = 'ubuntu'
-#    env.hosts = [instance.ip]
-    with settings(host_string=instance.ip):
-        res = fabric.operations.run(_make_download_script(code_url))
+    code_script = ship_code(uconf, conf, exclude_file)
+    print(_run_remote_script(instance.ip, code_script, uconf))
 
 @click.command()
 @click.pass_context
@@ -365,40 +635,32 @@ def rsync(ctx):
         fabric.operations.run("sudo chmod -R g+rwx /home/rstudio/research")
         fabric.operations.run("sudo chown -R rstudio:ubuntu /home/rstudio/research")
 
-    if os.path.exists(".exclude"):
-        exclude_cmd = ["--exclude-from", ".exclude"]
-    else:
-        exclude_cmd = []
-
-    cmd = (["rsync",
-            "-avzO",
-            "--no-owner",
-            "--no-perms"
-            # "-p",
-            # "--owner",
-            # "rstudio",
-            # "--group",
-            # "ubuntu"
-    ] + exclude_cmd +
-           ["-e",
-            'ssh -i {}'.format(expanduser(uconf.PATH_TO_KEY)),
-            ".",
-            "{}@{}:/home/rstudio/research".format(
-                uconf.SSH_USER_NAME,
-                instance.ip)])
-    _highlight("Prepping to sync entire code directory")
-    print(cmd)
-
-    get_total_size = (cmd[:1] + ["-vnaz"] + cmd[2:])
-    ps = subprocess.Popen(get_total_size,
-                          stdout=subprocess.PIPE)
-    output = subprocess.check_output(('grep', 'total'),
-                                     stdin=ps.stdout)
-    ps.wait()
-    _highlight(output.decode("utf-8").strip())
-
-    if click.confirm('Do you want to continue?'):
-        subprocess.call(cmd)
+    # the files to send are listed locally, with the same exclude rules the
+    # archive uses, instead of leaving it to rsync
+    matcher = excludes.ExcludeMatcher.from_file(".exclude")
+    _highlight("Prepping to sync entire code directory: {}".format(
+        excludes.format_summary(*excludes.summarize(".", matcher))))
+    with excludes.files_from(".", matcher) as file_list:
+        cmd = (["rsync",
+                "-avzO",
+                "--no-owner",
+                "--no-perms",
+                # "-p",
+                # "--owner",
+                # "rstudio",
+                # "--group",
+                # "ubuntu"
+                "--files-from", file_list] +
+               ["-e",
+                'ssh -i {}'.format(expanduser(uconf.PATH_TO_KEY)),
+                ".",
+                "{}@{}:/home/rstudio/research".format(
+                    uconf.SSH_USER_NAME,
+                    instance.ip)])
+        print(cmd)
+
+        if click.confirm('Do you want to continue?'):
+            subprocess.call(cmd)
     with settings(host_string=instance.ip):
         fabric.operations.run("sudo mkdir -p /home/rstudio/research")
         fabric.operations.run("sudo chmod -R g+rwx /home/rstudio/research")
@@ -422,7 +684,7 @@ run.add_command(rsync)
 @click.argument("n")
 @click.pass_context
 def data(ctx, conf, n):
-    instance = from_json(conf, n)
+    instance = from_registry(conf, n)
     ctx.obj['instance'] = instance
     ctx.obj['conf'] = conf
     pass
@@ -434,7 +696,7 @@ def diff(ctx):
     conf = ctx.obj['conf']
     uconf = paths._load_config(conf)
     if os.path.exists(".exclude_data"):
-        exclude_cmd = ["--exclude_from", ".exclude_data"]
+        exclude_cmd = ["--exclude-from", ".exclude_data"]
     else:
         exclude_cmd = []
     cmd = (["rsync",
@@ -461,10 +723,6 @@ def sync(ctx, which_dir, pull, dry):
     instance = ctx.obj['instance']
     conf = ctx.obj['conf']
     uconf = paths._load_config(conf)
-    if os.path.exists(".exclude_data"):
-        exclude_cmd = ["--exclude_from", ".exclude_data"]
-    else:
-        exclude_cmd = []
     #rsync -avz -e "ssh -p1234  -i /home/username/.ssh/1234-identity" dir user@server:
 
     if which_dir == 'data':
@@ -489,29 +747,46 @@ def sync(ctx, which_dir, pull, dry):
     opts = "-avzO"
     if dry:
         opts = "-navzO"
-    cmd = (["rsync",
-            opts] +
-            ["--no-owner",
-             "--no-perms"] +
-           exclude_cmd +
-           ["-e",
-            'ssh -i {}'.format(expanduser(uconf.PATH_TO_KEY)),
-            "{}".format(dirname),
-            "{}@{}:/home/rstudio/research/{}".format(
-                uconf.SSH_USER_NAME,
-                instance.ip,
-                target_dir)])
-    # print(cmd)
-    # print(len(cmd))
-    if pull:
-        # swap target and source
-        t = cmd[-2]
-        cmd[-2] = cmd[-1]
-        cmd[-1] = t
-    _highlight("Syncing files using rsync...")
-    print("command: ", cmd)
-    if click.confirm('Do you want to continue?'):
-        subprocess.call(cmd)
+    with contextlib.ExitStack() as stack:
+        if pull:
+            # we can't list the remote side, so rsync applies the excludes there
+            if os.path.exists(".exclude_data"):
+                exclude_cmd = ["--exclude-from", ".exclude_data"]
+            else:
+                exclude_cmd = []
+        else:
+            # list what to send locally, with the same rules as the archive
+            matcher = excludes.ExcludeMatcher.from_file(".exclude_data")
+            _highlight("Pushing {}".format(excludes.format_summary(*excludes.summarize(dirname, matcher))))
+            file_list = stack.enter_context(excludes.files_from(dirname, matcher))
+            # paths in the list are relative to dirname, so send its contents
+            # into its copy on the instance
+            exclude_cmd = ["--files-from", file_list]
+            dirname = dirname.rstrip("/") + "/"
+            target_dir = dirname
+        cmd = (["rsync",
+                opts] +
+                ["--no-owner",
+                 "--no-perms"] +
+               exclude_cmd +
+               ["-e",
+                'ssh -i {}'.format(expanduser(uconf.PATH_TO_KEY)),
+                "{}".format(dirname),
+                "{}@{}:/home/rstudio/research/{}".format(
+                    uconf.SSH_USER_NAME,
+                    instance.ip,
+                    target_dir)])
+        # print(cmd)
+        # print(len(cmd))
+        if pull:
+            # swap target and source
+            t = cmd[-2]
+            cmd[-2] = cmd[-1]
+            cmd[-1] = t
+        _highlight("Syncing files using rsync...")
+        print("command: ", cmd)
+        if click.confirm('Do you want to continue?'):
+            subprocess.call(cmd)
 
 data.add_command(diff)
 data.add_command(sync)
@@ -525,6 +800,9 @@ cli.add_command(launch)
 cli.add_command(config)
 cli.add_command(run)
 cli.add_command(data)
+cli.add_command(prices)
+cli.add_command(instances)
+cli.add_command(status)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+""" Ranking of instance types of different sizes by price per unit of compute """
+import importlib
+import os
+import sys
+import types
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('KEY_NAME', 'test')
+sys.path.insert(0, os.path.dirname(REPO_DIR))
+sys.path.insert(0, REPO_DIR)
+PACKAGE = os.path.basename(REPO_DIR)
+price_series = importlib.import_module(PACKAGE + '.utils.price_series')
+az_zone = importlib.import_module(PACKAGE + '.utils.az_zone')
+
+BID = 0.8
+# c5.large: $0.30 for 2 vCPUs, c5.18xlarge: $0.70 for 72 vCPUs
+SMALL = ('c5.large', 0.30, 2.0)
+BIG = ('c5.18xlarge', 0.70, 72.0)
+
+
+def _series(price):
+    return price_series.PriceSeries([300, 200, 100], [price] * 3)
+
+
+def _candidate(instance_type, price, units):
+    az = types.SimpleNamespace(region='us-east-1', name='us-east-1a')
+    return az_zone.Candidate(az, instance_type, _series(price), units)
+
+
+class TestPricePerUnit(unittest.TestCase):
+
+    def test_bigger_type_cheaper_per_unit_wins(self):
+        small, big = _candidate(*SMALL), _candidate(*BIG)
+        self.assertGreater(big.calculate_score(BID), small.calculate_score(BID))
+
+    def test_score_series_matches_calculate_score(self):
+        candidates = [_candidate(*SMALL), _candidate(*BIG)]
+        scores = price_series.score_series([c.price_series for c in candidates], BID,
+                                           units=[c.units for c in candidates])
+        for candidate, vectorized in zip(candidates, scores):
+            self.assertAlmostEqual(candidate.calculate_score(BID), vectorized, places=5)
+        self.assertGreater(scores[1], scores[0])
+
+    def test_over_the_bid_is_filtered_on_the_raw_price(self):
+        # $0.90 is over the bid, however cheap it is per vCPU
+        self.assertEqual(_candidate('c5.18xlarge', 0.90, 72.0).calculate_score(BID), 0)
+        scores = price_series.score_series([_series(0.90)], BID, units=[72.0])
+        self.assertEqual(scores[0], 0)
+
+    def test_empty_series(self):
+        empty = price_series.PriceSeries([], [])
+        self.assertEqual(price_series.score_series([empty], BID, units=[2.0])[0], -1e10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+import time
+from concurrent import futures
+
+from . import paths
+from . import clients
+from configs import default as uconf
+
+_cache_lock = threading.Lock()
+
+
+def _cache_path():
+    return os.path.join(paths._custom_path(), "ami_ids.json")
+
+
+def _cache_key(name, region, owners):
+    return "{}|{}|{}".format(region, name, ",".join(sorted(owners or [])))
+
+
+def _load_cache():
+    path = _cache_path()
+    if os.path.isfile(path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            print(">> Ignoring unreadable AMI cache {}: {}".format(path, e))
+    return {}
+
+
+def _update_cache(found):
+    """ Merges {key: image_id} into the cache file """
+    path = _cache_path()
+    with _cache_lock:
+        cache = _load_cache()
+        now = time.time()
+        for key, image_id in found.items():
+            cache[key] = {'image_id': image_id, 'fetched_at': now}
+        paths._write_atomically(path, lambda f: json.dump(cache, f, indent=2, sort_keys=True))
+
+
+def find_ami_id(name, region, owners=uconf.AMI_OWNERS):
+    """ Asks AWS for the ID of the image called `name` in `region`, owned by
+    one of `owners` (any owner, if None). The newest one wins if there are
+    several. Returns None if there's no match. """
+    client = clients.get_client('ec2', region)
+    kwargs = {'Filters': [{'Name': 'name', 'Values': [name]}]}
+    if owners:
+        kwargs['Owners'] = list(owners)
+    images = client.describe_images(**kwargs)['Images']
+    if not images:
+        return None
+    return max(images, key=lambda image: image.get('CreationDate', ''))['ImageId']
+
+
+def get_ami_id(name, region, owners=uconf.AMI_OWNERS, max_age=uconf.AMI_CACHE_EXPIRE_SEC):
+    """ Returns the ID of the image called `name` in `region`, from the cache
+    in ~/.lab_config if we looked it up less than `max_age` seconds ago. """
+    key = _cache_key(name, region, owners)
+    entry = _load_cache().get(key)
+    if entry and entry['fetched_at'] > time.time() - max_age:
+        return entry['image_id']
+
+    image_id = find_ami_id(name, region, owners)
+    # Don't remember misses: the image may just not have been copied there yet
+    if image_id is not None:
+        _update_cache({key: image_id})
+    return image_id
+
+
+def prefetch_ami_ids(name, regions, owners=uconf.AMI_OWNERS, max_age=uconf.AMI_CACHE_EXPIRE_SEC):
+    """ Looks up the image in every region that isn't cached yet, all at once,
+    so later calls to get_ami_id are answered from the cache. Returns
+    {region: image_id or None}. """
+    cache = _load_cache()
+    fresh_after = time.time() - max_age
+    ami_ids = {}
+    missing = []
+    for region in regions:
+        entry = cache.get(_cache_key(name, region, owners))
+        if entry and entry['fetched_at'] > fresh_after:
+            ami_ids[region] = entry['image_id']
+        else:
+            missing.append(region)
+    if not missing:
+        return ami_ids
+
+    def lookup(region):
+        try:
+            return find_ami_id(name, region, owners)
+        except Exception as e:
+            print(">> Failed to look up AMI {} in {}: {}".format(name, region, e))
+            return None
+
+    with futures.ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        found = dict(zip(missing, executor.map(lookup, missing)))
+    _update_cache(dict((_cache_key(name, region, owners), image_id)
+                       for region, image_id in found.items() if image_id is not None))
+    ami_ids.update(found)
+    return ami_ids
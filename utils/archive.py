@@ -0,0 +1,216 @@
+import os
+import uuid
+import base64
+import hashlib
+import tarfile
+import threading
+from concurrent import futures
+
+from . import code_sync
+from . import compression
+
+# S3 needs every part but the last to be at least 5MB
+PART_SIZE = 8 * 1024 * 1024
+# How many parts can be uploading at once. Together with the one being filled,
+# this bounds how much of the archive is held in memory.
+MAX_PARTS_IN_FLIGHT = 4
+# Bump this whenever what goes into an archive changes, so archives uploaded
+# before aren't mistaken for new ones with the same files
+ARCHIVE_FORMAT = 2
+# Who owns the code on the instance. Entries are stamped with these names and
+# group rwx permissions, so extracting as root with --same-owner puts
+# everything in place without a recursive chown/chmod afterwards.
+OWNER = 'rstudio'
+GROUP = 'ubuntu'
+
+
+def tree_digest(manifest):
+    """ A hash of everything that goes into the archive (paths, modes and file
+    hashes), so an unchanged tree always maps to the same archive name. Built
+    from the manifest's cached hashes, so it doesn't re-read the files. """
+    digest = hashlib.sha224("format {}\n".format(ARCHIVE_FORMAT).encode("utf-8"))
+    for entry in sorted(manifest, key=lambda entry: entry['path']):
+        digest.update("{}\0{:o}\0{}\n".format(entry['path'], entry['mode'], entry['sha']).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class MultipartWriter():
+    """ A write-only file object that uploads what's written to it as an S3
+    multipart upload. Full parts are uploaded in the background, at most
+    MAX_PARTS_IN_FLIGHT at a time; write() blocks while that many are
+    outstanding. """
+
+    def __init__(self, s3, bucket, key, part_size=PART_SIZE, max_in_flight=MAX_PARTS_IN_FLIGHT):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._parts = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_in_flight)
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._submit(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, number, body):
+        try:
+            md5 = base64.b64encode(hashlib.md5(body).digest()).decode("ascii")
+            response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+                                           UploadId=self.upload_id, PartNumber=number,
+                                           Body=body, ContentMD5=md5)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        finally:
+            self._slots.release()
+
+    def _submit(self, body):
+        # surface a failed part as soon as possible, instead of at the end
+        for future in self._parts:
+            if future.done() and future.exception():
+                raise future.exception()
+        self._slots.acquire()
+        self._parts.append(self._executor.submit(self._upload_part, len(self._parts) + 1, body))
+
+    def close(self):
+        """ Uploads what's left and completes the upload """
+        try:
+            if self._buffer or not self._parts:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            parts = [future.result() for future in self._parts]
+            self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                              UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def abort(self):
+        self._executor.shutdown(wait=True)
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def _owned(info):
+    info.uid = info.gid = 0
+    info.uname = OWNER
+    info.gname = GROUP
+    info.mode |= 0o070
+    return info
+
+
+class _HashingReader():
+    """ Reads a file, hashing what's read on the way """
+
+    def __init__(self, f):
+        self._f = f
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.sha.update(data)
+        return data
+
+
+def write_archive(root, manifest, fileobj, codec, level=None):
+    """ Writes a tarball of the manifest's files, compressed with codec, to
+    fileobj as a stream, so no more than a compression buffer is held at once.
+    Entries without a sha get one, from the same read that archives them.
+
+    Every directory gets its own entry, ahead of its files, and every entry
+    belongs to OWNER:GROUP with group rwx, so the archive can be extracted
+    straight into place. """
+    added_dirs = set()
+    with compression.compressor(codec, fileobj, level) as out:
+        with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+            for entry in manifest:
+                parents = []
+                parent = os.path.dirname(entry['path'])
+                while parent and parent not in added_dirs:
+                    parents.append(parent)
+                    parent = os.path.dirname(parent)
+                for parent in reversed(parents):
+                    tar.addfile(_owned(tar.gettarinfo(os.path.join(root, parent), arcname=parent)))
+                    added_dirs.add(parent)
+
+                path = os.path.join(root, entry['path'])
+                info = _owned(tar.gettarinfo(path, arcname=entry['path']))
+                if info.isreg():
+                    with open(path, "rb") as f:
+                        reader = _HashingReader(f)
+                        tar.addfile(info, reader)
+                    if entry['sha'] is None:
+                        entry['sha'] = reader.sha.hexdigest()
+                else:
+                    tar.addfile(info)
+
+
+def _stream_archive(s3, bucket, key, root, manifest, codec, level):
+    print(">> Streaming {} archive of {} files to s3://{}/{}".format(
+        codec.name, len(manifest), bucket, key))
+    writer = MultipartWriter(s3, bucket, key)
+    try:
+        write_archive(root, manifest, writer, codec, level)
+    except Exception:
+        writer.abort()
+        raise
+    writer.close()
+    print(">> Uploaded {:.1f}MB".format(writer.bytes_written / 1024 / 1024))
+
+
+def upload_archive(root, name, s3_bucket, exclude_file=None, endpoint_url=None,
+                   codec='auto', level=None, expires=60 * 60 * 24):
+    """ Archives the tree under root straight into S3. Returns a presigned
+    URL to the archive, and the Codec it's compressed with (see
+    utils/compression.py; 'auto' picks one from a sample of the tree).
+
+    The archive is named after a digest of the tree, so an identical tree is
+    never uploaded twice. Every file is read once: if the manifest cache
+    already knows every file's hash, the digest is known up front, and if an
+    archive with that name exists nothing is archived at all. Otherwise files
+    are hashed as they're archived, to a temporary key that's then copied to
+    the digest's name (or just deleted, if that turns out to exist already).
+    The tarball is compressed and uploaded in parts as it's written, without
+    touching the disk.
+    """
+    bucket, prefix = code_sync.split_s3_url(s3_bucket)
+    s3 = code_sync.s3_client(endpoint_url)
+    manifest = code_sync.build_manifest(root, exclude_file, hash_changed=False)
+    codec = compression.choose(codec, root, manifest)
+
+    def digest_key():
+        return code_sync.s3_key(prefix, "{}_{}{}".format(name, tree_digest(manifest), codec.extension))
+
+    if all(entry['sha'] for entry in manifest):
+        key = digest_key()
+        if code_sync.object_exists(s3, bucket, key):
+            print(">> s3://{}/{} is already uploaded, skipping".format(bucket, key))
+        else:
+            _stream_archive(s3, bucket, key, root, manifest, codec, level)
+    else:
+        tmp_key = code_sync.s3_key(prefix, "tmp", "{}_{}{}".format(name, uuid.uuid4().hex, codec.extension))
+        _stream_archive(s3, bucket, tmp_key, root, manifest, codec, level)
+        try:
+            key = digest_key()
+            if code_sync.object_exists(s3, bucket, key):
+                print(">> s3://{}/{} was already uploaded".format(bucket, key))
+            else:
+                s3.copy({'Bucket': bucket, 'Key': tmp_key}, bucket, key)
+        finally:
+            s3.delete_object(Bucket=bucket, Key=tmp_key)
+        code_sync.remember_hashes(root, manifest)
+
+    url = s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key},
+                                    ExpiresIn=expires)
+    return url, codec
@@ -2,23 +2,32 @@ import os
 import random
 import time
 import webbrowser
-import socket
 import datetime
 import subprocess
 import json
-import boto3
+import threading
 
 from .. import configs
 from configs import default as uconf
 from os.path import expanduser
 from .aws_spot_exception import SpotConstraintException
+from .poller import SpotRequestPoller
+from . import readiness
 from . import paths
+from . import clients
+from . import registry
 
 # class MyEncoder(json.JSONEncoder):
 #     def default(self, obj):
 #         if not isinstance(obj, Tree):
 #             return super(MyEncoder, self).default(obj)
 
+_ansible_hosts_lock = threading.Lock()
+# Instances that share a security group are set up concurrently, so only
+# one of them at a time may check and update it, and only the first needs to
+_security_groups_lock = threading.Lock()
+_opened_security_groups = set()
+
 class MyEncoder(json.JSONEncoder):
         def default(self, o):
             print(o)
@@ -27,28 +36,52 @@ class MyEncoder(json.JSONEncoder):
             except:
                 return None
 
-def from_json(conf, n):
+def _from_legacy_json(conf, n):
+    """ Reads an instance saved by older versions, which wrote a positional
+    JSON list per instance, and moves it into the registry. Returns None if
+    there's no such file. """
     path = os.path.join(paths._custom_path(),
                         "instances",
                         "{}_{}.json".format(conf, n))
+    if not os.path.exists(path):
+        return None
     with open(path, 'r') as f:
-            s = json.load(f)
+        s = json.load(f)
     random_id,az_zone,region, instance_type,ip, bid, ami_id,key_name, security_group_id,security_group_name,group_name, spot_instance_request_id,instance_id, ip, config_name = s
 
-    si = AWSSpotInstance(region,
-                         az_zone,
-                         instance_type,
-                         ami_id,
-                         uconf.BID,
-                         config_name)
+    si = AWSSpotInstance(region, az_zone, instance_type, ami_id, bid, config_name)
     si.random_id = random_id
     si.security_group_id = security_group_id
-    si.security_group_name = security_group_name,
+    si.security_group_name = security_group_name
     si.spot_instance_request_id = spot_instance_request_id
     si.instance_id = instance_id
     si.ip = ip
-    #print(">> created instance with ip: ", si.ip, ip)
-    si.start_boto()
+    si.register(n, 'running')
+    os.remove(path)
+    return si
+
+
+def from_registry(conf, n):
+    """ Returns instance `n` of config `conf`, as recorded in the local
+    instance registry. Doesn't talk to AWS. """
+    record = registry.InstanceRegistry().get(conf, n)
+    if record is None:
+        si = _from_legacy_json(conf, n)
+        if si is None:
+            raise Exception("No instance {} of {} in the registry. Run `labbox instances ls` "
+                            "to see the instances we know about.".format(n, conf))
+        return si
+
+    si = AWSSpotInstance(record['region'],
+                         record['az_zone'],
+                         record['instance_type'],
+                         record['ami_id'],
+                         record['bid'],
+                         record['config_name'])
+    for field in ('random_id', 'security_group_id', 'security_group_name',
+                  'spot_instance_request_id', 'instance_id', 'ip', 'launched_at'):
+        setattr(si, field, record[field])
+    si.status = record['status']
     return si
 
 
@@ -72,10 +105,7 @@ class AWSSpotInstance():
         self.GROUP_NAME = uconf.GROUP_NAME
 
         # == Boto3 related tools ==
-        boto3.setup_default_session(region_name=self.region)
-        self.client = boto3.client('ec2')
-        session = boto3.session.Session(region_name=self.region)
-        self.ec2_instance = session.resource('ec2')
+        self.client = clients.get_client('ec2', self.region)
 
         self.group_name = uconf.GROUP_NAME
 
@@ -84,29 +114,22 @@ class AWSSpotInstance():
         self.instance_id = None
         self.status_code = None
         self.ip = None
+        self.launched_at = None
+        # Last known state, as recorded in the registry
+        self.status = None
 
-    def serialize(self, n):
-        self.serializable = [self.random_id, self.az_zone,
-                             self.region, self.instance_type,
-                             self.ip, self.bid, self.ami_id,
-                             self.key_name, self.security_group_id,
-                             self.security_group_name,
-                             self.group_name, self.spot_instance_request_id,
-                             self.instance_id, self.ip, self.config_name]
-        instances_path = os.path.join(paths._custom_path(),
-                                      "instances")
-        if not os.path.exists(instances_path):
-            os.mkdir(instances_path)
-        path = os.path.join(instances_path,
-                            "{}_{}.json".format(self.group_name, n))
-        with open(path, 'w') as f:
-            json.dump(self.serializable, f)
+    def register(self, n, status):
+        """ Records this instance as number `n` of its config in the local
+        instance registry, so `labbox run CONF N` can find it later """
+        registry.InstanceRegistry().save(self, n, status)
 
     def start_boto(self):
-        boto3.setup_default_session(region_name=self.region)
-        self.client = boto3.client('ec2')
-        session = boto3.session.Session(region_name=self.region)
-        self.ec2_instance = session.resource('ec2')
+        self.client = clients.get_client('ec2', self.region)
+
+    @property
+    def ec2_instance(self):
+        # resources aren't thread safe, so always use the current thread's
+        return clients.get_resource('ec2', self.region)
 
     def request_instance(self):
         """Boots the instance on AWS"""
@@ -132,6 +155,7 @@ class AWSSpotInstance():
             }
         )
         self.spot_instance_request_id = response.get('SpotInstanceRequests')[0].get('SpotInstanceRequestId')
+        self.launched_at = time.time()
         print(response.get("SpotInstanceRequests")[0])
         return response
 
@@ -151,6 +175,23 @@ class AWSSpotInstance():
         )
         return response
 
+    def abandon(self):
+        """Cancels the spot request and terminates any instance it started.
+
+        The request is described again after it's cancelled, since AWS may
+        have fulfilled it after we last polled, and cancelling a request
+        leaves its instance running.
+        """
+        if self.spot_instance_request_id:
+            self.cancel_spot_request()
+            response = self.client.describe_spot_instance_requests(
+                SpotInstanceRequestIds=[self.spot_instance_request_id],
+            )
+            for request in response.get('SpotInstanceRequests', []):
+                self.instance_id = self.instance_id or request.get('InstanceId')
+        if self.instance_id:
+            self.terminate()
+
 
     def open_http_and_ssh(self):
         from . import security_groups as sg
@@ -165,13 +206,18 @@ class AWSSpotInstance():
         #self.security_groups = self.ec2_instance.Instance(self.instance_id).groups
 
         self.vpc = self.ec2_instance.Vpc(instance.vpc_id)
-        group = sg.get_or_create_security_group(
-            self.client,
-            self.security_group_name,
-            vpc_id=self.vpc.vpc_id)
-        sg.update_security_group(self.client,
-                                 group,
-                                 rules)
+        key = (self.region, self.vpc.vpc_id, self.security_group_name)
+        with _security_groups_lock:
+            if key in _opened_security_groups:
+                return
+            group = sg.get_or_create_security_group(
+                self.client,
+                self.security_group_name,
+                vpc_id=self.vpc.vpc_id)
+            sg.update_security_group(self.client,
+                                     group,
+                                     rules)
+            _opened_security_groups.add(key)
 
     def get_ip(self):
         if self.ip:
@@ -179,29 +225,16 @@ class AWSSpotInstance():
             return self.ip
 
         print(">> No IP, checking status... {}".format(self.ip))
-        if not self.status_code:
-            self.get_spot_request_status()
-
-        for idx in range(100):
-            if not self.instance_id:
-                if 'pending' in self.status_code:
-                    time.sleep(3)
-                    self.get_spot_request_status()
-                else:
-                    raise SpotConstraintException("Spot constraints can't be met: " + self.status_code)
-            else:
-                self.ip = self.ec2_instance.Instance(self.instance_id).public_ip_address
-                break
-
-        # TODO: improve this
-        if not self.ip:
-            raise Exception('There is no public IP address for this instance... Maybe the bid failed..')
+        ready, failed = SpotRequestPoller([self]).wait()
+        if self in failed:
+            raise SpotConstraintException(failed[self])
 
         return self.ip
 
     def terminate(self):
         """Terminates the instance on AWS"""
-        pass
+        print(">> Terminating instance {}".format(self.instance_id))
+        return self.client.terminate_instances(InstanceIds=[self.instance_id])
 
     def open_ssh_term(self):
         """Opens your default terminal and starts SSH session to the instance"""
@@ -221,8 +254,10 @@ class AWSSpotInstance():
     def add_to_ansible_hosts(self):
         home = expanduser("~")
         path = "{}/.lab_configs/ansible".format(home)
-        with open(os.path.join(path, '{}_hosts'.format(self.GROUP_NAME)), 'a') as file:
-            file.write(str(self.ip) + '\n')
+        # instances are brought up concurrently, and all append to this file
+        with _ansible_hosts_lock:
+            with open(os.path.join(path, '{}_hosts'.format(self.GROUP_NAME)), 'a') as file:
+                file.write(str(self.ip) + '\n')
 
     def wait_for_http(self, port=80, timeout=uconf.SERVER_TIMEOUT):
         """Waits until port 80 is open on this instance.
@@ -237,12 +272,10 @@ class AWSSpotInstance():
         self.wait_for_port(port, timeout)
 
     def wait_for_port(self, port, timeout=uconf.SERVER_TIMEOUT):
-        """Waits until port is open on this instance.
+        """Waits until port is open on this instance, and speaking SSH or HTTP
+        if it's port 22 or 80.
         This is a useful way to check if the system has booted and the HTTP server is running.
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        start = datetime.datetime.now()
         print(">> waiting for port", port)
 
         if not self.get_ip():
@@ -251,23 +284,9 @@ class AWSSpotInstance():
         print(">> Creating security group in VPC...")
         self.open_http_and_ssh()
 
-        while True:
-            # We need this try block because depending on the parameters the system will cause the connection
-            # to timeout early.
-            try:
-                if sock.connect_ex((self.get_ip(), port)):
-                    # we got a connection, lets return
-                    return
-                else:
-                    time.sleep(3)
-            except:
-                # TODO: catch the timeout exception and ignore that, but every other exception should be raised
-                # The system timeout, no problem
-                pass
-
-            if (datetime.datetime.now() - start).seconds > timeout:
-                print((datetime.datetime.now() - start).seconds)
-                raise Exception("Connection timed out. Try increasing the timeout amount, or fix your server.")
+        result = readiness.probe_hosts([(self.ip, port, self.launched_at)], timeout)[0]
+        if not result.ready:
+            raise Exception("Connection timed out. Try increasing the timeout amount, or fix your server.")
 
         print(">> port %s is live" % (port))
 
@@ -1,6 +1,5 @@
 import datetime
-import numpy as np
-import boto3
+import time
 import sys
 import os
 
@@ -9,60 +8,86 @@ sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 #import aws_spot_bot.config.default as uconf
 from .. import configs
 from configs import default as uconf
-
-
-class AZZone():
-
-    def __init__(self, region, name):
-        self.region = region
-        self.name = name
-        boto3.setup_default_session(region_name=self.region)
-        self.client = boto3.client('ec2')
-        self.spot_pricing_history = None
+from . import price_store
+from . import clients
+from .price_series import PriceSeries, score, score_series
+from . import instance_types as instance_types_util
+
+# How far back spot price history is scored over
+HISTORY_DAYS = 7
+
+
+def _window_start():
+    return time.time() - HISTORY_DAYS * 24 * 60 * 60
+
+
+def iter_spot_price_pages(client, **kwargs):
+    """ Yields spot price history a response page (a list of records) at a
+    time, following NextToken. Pages are only requested as they are consumed,
+    so a caller that stops iterating early stops paging.
+    """
+    while True:
+        response = client.describe_spot_price_history(**kwargs)
+        yield response.get('SpotPriceHistory', [])
+        next_token = response.get('NextToken')
+        if not next_token:
+            return
+        kwargs['NextToken'] = next_token
+
+
+def iter_spot_price_history(client, **kwargs):
+    """ Yields spot price history records one at a time, across pages """
+    for page in iter_spot_price_pages(client, **kwargs):
+        for record in page:
+            yield record
+
+
+def read_price_series(store, az_name, instance_types, product_descriptions=['Linux/UNIX'],
+                      max_samples=uconf.SPOT_PRICING_MAX_SAMPLES):
+    """ Returns {instance_type: PriceSeries} for an AZ from the store, newest
+    first and at most `max_samples` records each. The series covers the
+    scoring window, and starts with the price in effect when the window
+    opens, so a price that hasn't changed in a while still counts. """
+    return dict((instance_type,
+                 PriceSeries.from_rows(store.iter_prices(az_name, [instance_type], product_descriptions,
+                                                         since=_window_start(), limit=max_samples)))
+                for instance_type in instance_types)
+
+
+class Candidate():
+    """ One instance type in one AZ. This is what gets ranked and launched. """
+
+    def __init__(self, az, instance_type, price_series, units=1.0):
+        self.az = az
+        self.region = az.region
+        self.az_name = az.name
+        self.instance_type = instance_type
+        self.price_series = price_series
+        self.units = units
         self.score = None
 
     @property
     def spot_price_variance(self):
-        prices = [float(record['SpotPrice']) for record in self.spot_pricing_history]
-        return np.var(prices)
+        return self.price_series.variance
 
     @property
     def spot_price_mean(self):
-        prices = [float(record['SpotPrice']) for record in self.spot_pricing_history]
-        return np.mean(prices)
+        return self.price_series.mean
 
     @property
     def current_price(self):
-        if self.spot_pricing_history:
-            return float(self.spot_pricing_history[0]['SpotPrice'])
-        elif self.spot_pricing_history == []:
-            return None
-        else:
-            raise Exception("You must fetch the history before calling this property")
+        return self.price_series.current_price
 
-    def get_spot_pricing_history(self, instance_types, product_descriptions=['Linux/UNIX']):
-        """ Returns the spot price history given a specified AZ and region."""
-        print("Getting spot prices for", self.name)
-
-        response = self.client.describe_spot_price_history(
-            DryRun=False,
-            StartTime=datetime.datetime.now() - datetime.timedelta(days=7),
-            EndTime=datetime.datetime.now(),
-            InstanceTypes=instance_types,
-            AvailabilityZone=self.name,
-            ProductDescriptions=product_descriptions)
-
-        self.spot_pricing_history = response.get('SpotPriceHistory', [])
-
-    def calculate_score(self, instance_types, bid, update=False):
-        if self.spot_pricing_history is None:
-            self.get_spot_pricing_history(instance_types)
-        elif update:
-            self.get_spot_pricing_history(instance_types)
+    @property
+    def price_per_unit(self):
+        if self.current_price is None:
+            return None
+        return self.current_price / self.units
 
+    def calculate_score(self, bid):
         # TODO: This should be removed but I am lazy and this is easier than catching exceptions
         # @jgre can you fix?
-        if self.spot_pricing_history == []:
+        if self.price_series.count == 0:
             self.score = -1e10
             return -1e10
 
@@ -71,13 +96,133 @@ class AZZone():
             self.score = 0
             return 0
 
-        # Here we multiply each item by a weight.
-        # These weights are arbitrary and probably not ideal.
-        # There is much room for improvement on this scoring algorithm, but this algorithm
-        # works for most light use cases. Feel free to contribute!
-        current_price_s = bid - self.current_price
-        variance_s = -5 * (self.spot_price_variance * self.spot_price_mean)
-        mean_s = 0.5 * (bid - self.spot_price_mean)
+        # Prices are scored per unit of compute, so instance types of
+        # different sizes can be compared. The bid is for the whole instance,
+        # so it isn't scaled; it only shifts every score by the same amount.
+        self.score = score(self.price_per_unit,
+                           self.spot_price_mean / self.units,
+                           self.spot_price_variance / self.units ** 2,
+                           bid)
+        return self.score
+
+
+class AZZone():
+
+    def __init__(self, region, name):
+        self.region = region
+        self.name = name
+        self.client = clients.get_client('ec2', self.region)
+        # {instance_type: PriceSeries}
+        self.price_series = None
+        self.score = None
+
+    def get_spot_pricing_history(self, instance_types, product_descriptions=['Linux/UNIX']):
+        """ Fetches and stores the spot price series for this AZ."""
+        get_region_spot_pricing_history([self], instance_types, product_descriptions)
+
+    def load_from_store(self, store, instance_types, product_descriptions=['Linux/UNIX'],
+                        max_samples=uconf.SPOT_PRICING_MAX_SAMPLES):
+        """ Loads this AZ's price series for each instance type from the store
+        (see read_price_series) """
+        self.price_series = read_price_series(store, self.name, instance_types,
+                                              product_descriptions, max_samples)
+
+    def candidates(self, units_by_type):
+        """ Returns a Candidate for each instance type in `units_by_type` """
+        return [Candidate(self, instance_type, self.price_series[instance_type], units)
+                for instance_type, units in units_by_type.items()]
+
+    def calculate_score(self, instance_types, bid, update=False,
+                        weights=uconf.COMPUTE_UNIT_WEIGHTS):
+        """ Scores every instance type in this AZ, and sets this AZ's score to
+        the best of them."""
+        if self.price_series is None:
+            self.get_spot_pricing_history(instance_types)
+        elif update:
+            self.get_spot_pricing_history(instance_types)
 
-        self.score = current_price_s + variance_s + mean_s
+        candidates = self.candidates(instance_types_util.compute_units_by_type(instance_types, weights))
+        self.score = max([c.calculate_score(bid) for c in candidates] or [-1e10])
         return self.score
+
+
+def score_candidates(candidates, bid):
+    """ Scores every candidate in one vectorized pass over their price series,
+    and sets `score` on each of them."""
+    scores = score_series([c.price_series for c in candidates], bid,
+                          units=[c.units for c in candidates])
+    for candidate, candidate_score in zip(candidates, scores):
+        candidate.score = float(candidate_score)
+    return candidates
+
+
+def fetch_region_spot_prices(region_azs, instance_types, product_descriptions=['Linux/UNIX'],
+                             max_samples=uconf.SPOT_PRICING_MAX_SAMPLES, store=None):
+    """ Brings the price store up to date for a region with a single paginated
+    query, and returns {az_name: {instance_type: PriceSeries}} read back from
+    it. The AZs themselves are left alone, so this can run in a worker thread
+    that the caller may stop waiting for.
+
+    Only records newer than the region's last complete fetch are requested.
+    Each page is written to the store as soon as it arrives, in a transaction
+    of its own, so regions fetched in parallel don't wait on each other's
+    round trips for the store's write lock. `region_azs` must all be AZZone
+    objects from the same region. If `max_samples` is set, paging stops once
+    every AZ has that many new records; such a fetch isn't complete, so the
+    next one starts from the same point again instead of leaving a gap.
+    """
+    store = store or price_store.PriceStore()
+    region = region_azs[0].region
+
+    window_start = _window_start()
+    since = store.last_fetched(region, instance_types, product_descriptions)
+    start_time = max(since, window_start) if since else window_start
+    print("Getting spot prices for {} since {}".format(
+        region, datetime.datetime.fromtimestamp(start_time)))
+
+    counts = dict((az.name, 0) for az in region_azs)
+    unfilled = set(counts)
+    fetched_at = time.time()
+    truncated = False
+
+    pages = iter_spot_price_pages(
+        region_azs[0].client,
+        DryRun=False,
+        StartTime=datetime.datetime.fromtimestamp(start_time, datetime.timezone.utc),
+        EndTime=datetime.datetime.fromtimestamp(fetched_at, datetime.timezone.utc),
+        InstanceTypes=instance_types,
+        ProductDescriptions=product_descriptions)
+    for page in pages:
+        if max_samples:
+            for i, record in enumerate(page):
+                az_name = record['AvailabilityZone']
+                if az_name in unfilled:
+                    counts[az_name] += 1
+                    if counts[az_name] >= max_samples:
+                        unfilled.discard(az_name)
+                if not unfilled:
+                    page = page[:i + 1]
+                    truncated = True
+                    break
+        store.add_records(region, page)
+        if truncated:
+            break
+
+    if not truncated:
+        store.mark_fetched(region, instance_types, product_descriptions, fetched_at)
+    store.prune(before=window_start - 24 * 60 * 60)
+
+    return dict((az.name, read_price_series(store, az.name, instance_types,
+                                            product_descriptions, max_samples))
+                for az in region_azs)
+
+
+def get_region_spot_pricing_history(region_azs, instance_types, product_descriptions=['Linux/UNIX'],
+                                    max_samples=uconf.SPOT_PRICING_MAX_SAMPLES, store=None):
+    """ Fetches a region's prices (see fetch_region_spot_prices) and sets
+    `price_series` on each AZ. Returns the AZs. """
+    price_series = fetch_region_spot_prices(region_azs, instance_types, product_descriptions,
+                                            max_samples, store)
+    for az in region_azs:
+        az.price_series = price_series[az.name]
+    return region_azs
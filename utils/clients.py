@@ -0,0 +1,65 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+from . import rate_limit
+
+# Building boto3 sessions and clients is slow, and boto3.setup_default_session
+# mutates global state, so everything gets its clients from here instead.
+# Clients are thread safe and shared by everyone. Resources aren't, so they
+# are cached per thread.
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_local = threading.local()
+
+
+def _credentials_key():
+    """ Identifies the credentials boto3 will pick up, so switching profile or
+    keys gets fresh sessions instead of cached ones. """
+    return (os.environ.get('AWS_PROFILE'),
+            os.environ.get('AWS_ACCESS_KEY_ID'))
+
+
+def _get_session(region):
+    key = (region, _credentials_key())
+    if key not in _sessions:
+        _sessions[key] = boto3.session.Session(region_name=region)
+    return _sessions[key]
+
+
+def get_client(service, region, **kwargs):
+    """ Returns the shared client for `service` in `region`. Extra keyword
+    arguments (e.g. endpoint_url) are passed on to boto3 and become part of
+    the cache key. EC2 clients are rate limited per region. """
+    key = (service, region, _credentials_key(), tuple(sorted(kwargs.items())))
+    with _lock:
+        if key not in _clients:
+            if service == 'ec2':
+                # botocore's own retries would swallow throttling errors
+                # before the rate limiter sees them, so the rate limiter
+                # retries throttling and transient errors alone
+                no_retries = Config(retries={'max_attempts': 0})
+                kwargs['config'] = kwargs['config'].merge(no_retries) if 'config' in kwargs else no_retries
+            client = _get_session(region).client(service, **kwargs)
+            if service == 'ec2':
+                client = rate_limit.limited_client(client, region)
+            _clients[key] = client
+        return _clients[key]
+
+
+def get_resource(service, region):
+    """ Returns this thread's resource for `service` in `region`. Its requests
+    go through the shared (and for EC2, rate limited) client. """
+    if not hasattr(_local, 'resources'):
+        _local.resources = {}
+    key = (service, region, _credentials_key())
+    if key not in _local.resources:
+        with _lock:
+            resource = _get_session(region).resource(service)
+        resource.meta.client = get_client(service, region)
+        _local.resources[key] = resource
+    return _local.resources[key]
@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+import threading
+from concurrent import futures
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+from . import paths
+from . import clients
+from . import excludes
+
+# Bump this whenever the layout of the local manifest cache changes
+MANIFEST_CACHE_VERSION = 1
+# How many files are hashed, or blobs uploaded, at once
+MAX_WORKERS = 8
+HASH_CHUNK_BYTES = 1024 * 1024
+
+
+def _cache_path(root):
+    key = hashlib.sha1(os.path.abspath(root).encode("utf-8")).hexdigest()
+    return os.path.join(paths._custom_path(), "manifests", "{}.json".format(key))
+
+
+def _load_cache(root):
+    path = _cache_path(root)
+    if os.path.isfile(path):
+        try:
+            with open(path, "r") as f:
+                cache = json.load(f)
+            if cache.get('version') == MANIFEST_CACHE_VERSION:
+                return cache
+        except Exception as e:
+            print(">> Ignoring unreadable manifest cache {}: {}".format(path, e))
+    return {'version': MANIFEST_CACHE_VERSION, 'files': {}, 'uploaded': {}}
+
+
+def _save_cache(root, cache):
+    paths._write_atomically(_cache_path(root), lambda f: json.dump(cache, f))
+
+
+def hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def build_manifest(root, exclude_file=None, hash_changed=True):
+    """ Returns [{'path', 'sha', 'size', 'mode'}] for every file to ship.
+
+    Hashes are remembered in ~/.lab_config/manifests, keyed by path, size and
+    mtime, so only new or changed files are read. With hash_changed=False
+    those aren't read at all, and get a sha of None: the caller hashes them
+    while reading them anyway, and hands them to remember_hashes.
+    """
+    known = _load_cache(root)['files']
+    manifest = []
+    to_hash = []
+    for relpath, _ in excludes.walk(root, excludes.ExcludeMatcher.from_file(exclude_file)):
+        st = os.stat(os.path.join(root, relpath))
+        entry = {'path': relpath, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                 'mode': st.st_mode & 0o777, 'sha': None}
+        cached = known.get(relpath)
+        if cached and cached['size'] == st.st_size and cached['mtime_ns'] == st.st_mtime_ns:
+            entry['sha'] = cached['sha']
+        else:
+            to_hash.append(entry)
+        manifest.append(entry)
+
+    print(">> {} files, {} new or changed".format(len(manifest), len(to_hash)))
+    if hash_changed:
+        with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            shas = executor.map(lambda entry: hash_file(os.path.join(root, entry['path'])), to_hash)
+            for entry, sha in zip(to_hash, shas):
+                entry['sha'] = sha
+        remember_hashes(root, manifest)
+    return manifest
+
+
+def remember_hashes(root, manifest):
+    """ Saves the manifest's hashes in the cache, for the next build_manifest """
+    cache = _load_cache(root)
+    cache['files'] = dict((entry['path'], {'size': entry['size'],
+                                           'mtime_ns': entry['mtime_ns'],
+                                           'sha': entry['sha']})
+                          for entry in manifest if entry['sha'])
+    _save_cache(root, cache)
+
+
+def split_s3_url(url):
+    """ 's3://bucket/some/prefix' -> ('bucket', 'some/prefix') """
+    parsed = urlparse(url)
+    return parsed.netloc, parsed.path.strip("/")
+
+
+def s3_key(prefix, *parts):
+    return "/".join([prefix] + list(parts)) if prefix else "/".join(parts)
+
+
+def s3_client(endpoint_url=None):
+    """ The S3 client to ship code with. endpoint_url points it at an S3
+    compatible service other than AWS (e.g. a local stand-in). """
+    if endpoint_url:
+        return clients.get_client('s3', None, endpoint_url=endpoint_url)
+    return clients.get_client('s3', None)
+
+
+def object_exists(s3, bucket, key):
+    """ Whether the bucket has an object at key """
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def upload_blobs(root, manifest, s3_bucket, endpoint_url=None):
+    """ Uploads the content of every file in the manifest that the bucket
+    doesn't have yet, as blobs named after their hash. Returns how many
+    were uploaded. """
+    bucket, prefix = split_s3_url(s3_bucket)
+    s3 = s3_client(endpoint_url)
+    cache = _load_cache(root)
+    uploaded = set(cache['uploaded'].get(s3_bucket, []))
+
+    by_sha = {}
+    for entry in manifest:
+        by_sha.setdefault(entry['sha'], entry['path'])
+    missing = [sha for sha in by_sha if sha not in uploaded]
+
+    lock = threading.Lock()
+    sent = []
+
+    def upload(sha):
+        key = s3_key(prefix, "blobs", sha)
+        if not object_exists(s3, bucket, key):
+            s3.upload_file(os.path.join(root, by_sha[sha]), bucket, key)
+            with lock:
+                sent.append(sha)
+
+    with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(upload, missing))
+
+    cache['uploaded'][s3_bucket] = sorted(uploaded | set(missing))
+    _save_cache(root, cache)
+    print(">> Uploaded {} of {} blobs ({} already in {})".format(
+        len(sent), len(by_sha), len(by_sha) - len(sent), s3_bucket))
+    return len(sent)
+
+
+def ship_tree(root, name, s3_bucket, exclude_file=None, endpoint_url=None,
+              expires=60 * 60 * 24):
+    """ Uploads the tree under root to S3, content addressed: only file
+    contents the bucket doesn't already have are sent. Returns a presigned
+    URL to a manifest that utils/restore_tree.py rebuilds the tree from. """
+    bucket, prefix = split_s3_url(s3_bucket)
+    s3 = s3_client(endpoint_url)
+    manifest = build_manifest(root, exclude_file)
+    upload_blobs(root, manifest, s3_bucket, endpoint_url)
+
+    # presigning is done locally, it doesn't talk to S3
+    files = [{'path': entry['path'],
+              'sha': entry['sha'],
+              'mode': entry['mode'],
+              'url': s3.generate_presigned_url('get_object',
+                                               Params={'Bucket': bucket,
+                                                       'Key': s3_key(prefix, "blobs", entry['sha'])},
+                                               ExpiresIn=expires)}
+             for entry in manifest]
+    body = json.dumps({'files': files}).encode("utf-8")
+    key = s3_key(prefix, "manifests", "{}_{}.json".format(name, hashlib.sha224(body).hexdigest()))
+    s3.put_object(Bucket=bucket, Key=key, Body=body)
+    return s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key},
+                                     ExpiresIn=expires)
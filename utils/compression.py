@@ -0,0 +1,160 @@
+import os
+import zlib
+import gzip
+import shutil
+import threading
+import contextlib
+import subprocess
+import collections
+
+# How an archive is compressed. `command` builds the compressor's command line
+# for a level (None compresses in-process), and `decompress` is the shell
+# command that undoes it on the instance, reading stdin and writing stdout.
+# `levels` is the (lowest, highest) level the codec takes.
+Codec = collections.namedtuple("Codec", ["name", "extension", "default_level", "levels",
+                                         "command", "decompress", "package"])
+
+CODECS = collections.OrderedDict((codec.name, codec) for codec in [
+    # multi-threaded, and much faster than gzip at a similar ratio
+    Codec('zstd', '.tar.zst', 3, (1, 19),
+          lambda level: ['zstd', '-T0', '-q', '-c', '-{}'.format(level)],
+          'zstd -dc', 'zstd'),
+    # parallel gzip. Its output is plain gzip, so the instance doesn't need pigz
+    Codec('pigz', '.tar.gz', 6, (1, 9),
+          lambda level: ['pigz', '-c', '-{}'.format(level)],
+          'gzip -dc', None),
+    Codec('gzip', '.tar.gz', 6, (1, 9), None, 'gzip -dc', None),
+    # for trees that are mostly compressed already (images, parquet...)
+    Codec('none', '.tar', None, None, None, 'cat', None),
+])
+
+# Below this compressed/raw ratio on the sample, compressing is worth it
+COMPRESSIBLE_RATIO = 0.9
+SAMPLE_FILES = 64
+SAMPLE_BYTES_PER_FILE = 64 * 1024
+_PIPE_CHUNK_BYTES = 1024 * 1024
+# How many times the instance tries to install a codec's package, waiting
+# APT_RETRY_SEC in between. Right after boot, cloud-init often holds the apt
+# lock for a while.
+APT_ATTEMPTS = 10
+APT_RETRY_SEC = 10
+
+
+def available(name):
+    """ Whether a codec can be used on this machine """
+    codec = CODECS[name]
+    return codec.command is None or shutil.which(codec.command(codec.default_level)[0]) is not None
+
+
+def sample_ratio(root, manifest):
+    """ How well the tree compresses: the zlib ratio of the start of up to
+    SAMPLE_FILES files, spread evenly over the manifest. 1.0 means not at all. """
+    step = max(1, len(manifest) // SAMPLE_FILES)
+    raw = compressed = 0
+    for entry in manifest[::step][:SAMPLE_FILES]:
+        with open(os.path.join(root, entry['path']), "rb") as f:
+            data = f.read(SAMPLE_BYTES_PER_FILE)
+        raw += len(data)
+        compressed += len(zlib.compress(data, 1))
+    return compressed / raw if raw else 1.0
+
+
+def choose(name, root=None, manifest=None):
+    """ Returns the Codec to use. 'auto' skips compression for trees that don't
+    compress, and otherwise picks the fastest codec installed here. Codecs
+    that aren't installed fall back to in-process gzip. """
+    if name == 'auto':
+        ratio = sample_ratio(root, manifest) if manifest else 1.0
+        print(">> Archive sample compresses to {:.0%}".format(ratio))
+        if ratio > COMPRESSIBLE_RATIO:
+            return CODECS['none']
+        installed = [name for name in ('zstd', 'pigz') if available(name)]
+        name = installed[0] if installed else 'gzip'
+    if name not in CODECS:
+        raise ValueError("Unknown archive codec {}. Pick one of: auto, {}".format(
+            name, ", ".join(CODECS)))
+    if not available(name):
+        print(">> {} isn't installed, compressing with gzip".format(name))
+        name = 'gzip'
+    return CODECS[name]
+
+
+def clamp_level(codec, level):
+    """ Returns the level to compress with: the codec's default for None,
+    otherwise `level` brought within what the codec takes. ARCHIVE_LEVEL is
+    shared by every codec, and 'auto' may pick any of them. """
+    if level is None or codec.levels is None:
+        return codec.default_level
+    lowest, highest = codec.levels
+    clamped = min(max(level, lowest), highest)
+    if clamped != level:
+        print(">> {} doesn't take level {}, using {}".format(codec.name, level, clamped))
+    return clamped
+
+
+def _copy(src, dst):
+    for chunk in iter(lambda: src.read(_PIPE_CHUNK_BYTES), b""):
+        dst.write(chunk)
+
+
+@contextlib.contextmanager
+def compressor(codec, fileobj, level=None):
+    """ Yields a file object; whatever's written to it is compressed with the
+    codec and written to fileobj, as a stream. """
+    level = clamp_level(codec, level)
+    if codec.name == 'none':
+        yield fileobj
+    elif codec.command is None:
+        with gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level, mtime=0) as gz:
+            yield gz
+    else:
+        proc = subprocess.Popen(codec.command(level), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        errors = []
+
+        def drain():
+            try:
+                _copy(proc.stdout, fileobj)
+            except Exception as e:
+                errors.append(e)
+                # stop the compressor, so the writer doesn't block forever
+                proc.kill()
+
+        reader = threading.Thread(target=drain)
+        reader.start()
+        try:
+            yield proc.stdin
+        except BrokenPipeError:
+            # the compressor went away, most likely because drain() killed it
+            # after fileobj failed. That failure is the one worth reporting.
+            reader.join()
+            proc.wait()
+            if errors:
+                raise errors[0]
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            reader.join()
+            status = proc.wait()
+        if errors:
+            raise errors[0]
+        if status != 0:
+            raise Exception("{} exited with status {}".format(codec.name, status))
+
+
+def install_command(codec):
+    """ Shell command that makes sure the instance can decompress the codec.
+    The package lists are updated first, and the install is retried while
+    something else holds the apt lock. """
+    if codec.package is None:
+        return ":"
+    apt = "sudo apt-get -q -o DPkg::Lock::Timeout={}".format(APT_RETRY_SEC)
+    return ("command -v {binary} >/dev/null || {{ "
+            "for attempt in $(seq {attempts}); do "
+            "{apt} update && {apt} install -y {package} && break; "
+            "sleep {wait}; done; "
+            "command -v {binary} >/dev/null; }}").format(
+                binary=codec.decompress.split()[0], package=codec.package, apt=apt,
+                attempts=APT_ATTEMPTS, wait=APT_RETRY_SEC)
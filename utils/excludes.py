@@ -0,0 +1,149 @@
+import os
+import re
+import tempfile
+import contextlib
+
+
+class ExcludeMatcher():
+    """ Decides which paths an exclude file (`.exclude`, `.exclude_data`)
+    leaves out, following rsync's rules for --exclude-from, so local listings
+    agree with what rsync itself excludes on a pull:
+
+    - a pattern starting with a slash is anchored at the root
+    - otherwise, a pattern without a slash (or **) matches the last component
+      of a path, i.e. a file or directory name anywhere, and one with a slash
+      matches the last components of a path, e.g. `foo/bar` matches
+      `foo/bar` and `src/foo/bar`
+    - a pattern ending in a slash only matches directories
+    - `*` and `?` don't match slashes, `**` matches anything, and `dir/***`
+      matches dir and everything in it
+    - blank lines and lines starting with # are ignored
+
+    rsync's include rules (`+ pattern`) and other filter rule prefixes aren't
+    supported. All the patterns are compiled into a regular expression per
+    kind of entry, so checking a path costs the same however many patterns
+    there are.
+    """
+
+    def __init__(self, patterns=()):
+        self.patterns = list(patterns)
+        regexes = {False: [], True: []}
+        for pattern in self.patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            regexes[dir_only].append(self._translate(pattern))
+        # {is_dir: regex}, dir patterns apply to directories on top of the others
+        self._regexes = dict((is_dir, self._compile(regexes[False] + (regexes[True] if is_dir else [])))
+                             for is_dir in (False, True))
+
+    @staticmethod
+    def _translate(pattern):
+        """ Turns an rsync pattern into a regex matching the relative paths it
+        excludes """
+        if pattern.startswith("/"):
+            anchor, pattern = "", pattern.lstrip("/")
+        else:
+            anchor = "(?:.*/)?"
+        tail = ""
+        if pattern.endswith("/***"):
+            pattern, tail = pattern[:-4], "(?:/.*)?"
+        parts = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if pattern.startswith("**", i):
+                parts.append(".*")
+                i += 2
+                continue
+            if c == "*":
+                parts.append("[^/]*")
+            elif c == "?":
+                parts.append("[^/]")
+            elif c == "\\" and i + 1 < len(pattern):
+                i += 1
+                parts.append(re.escape(pattern[i]))
+            elif c == "[" and "]" in pattern[i + 2:]:
+                end = pattern.index("]", i + 2)
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                parts.append("[{}]".format(body.replace("\\", "\\\\")))
+                i = end
+            else:
+                parts.append(re.escape(c))
+            i += 1
+        return anchor + "".join(parts) + tail
+
+    @staticmethod
+    def _compile(regexes):
+        if not regexes:
+            return None
+        return re.compile("(?:{})\\Z".format("|".join("(?:{})".format(r) for r in regexes)))
+
+    @classmethod
+    def from_file(cls, exclude_file):
+        """ Reads an exclude file. None (or a missing file) excludes nothing """
+        if exclude_file is None or not os.path.exists(exclude_file):
+            return cls()
+        with open(exclude_file, "r") as f:
+            return cls(f.read().splitlines())
+
+    def excluded(self, relpath, is_dir=False):
+        regex = self._regexes[is_dir]
+        return bool(regex and regex.match(relpath.replace(os.sep, "/")))
+
+
+def walk(root, matcher):
+    """ Yields (relative path, size) for every file under root the matcher
+    doesn't exclude, in sorted order. Excluded directories are never opened. """
+    stack = [""]
+    while stack:
+        reldir = stack.pop()
+        try:
+            entries = sorted(os.scandir(os.path.join(root, reldir)), key=lambda e: e.name)
+        except OSError as e:
+            print(">> Skipping {}: {}".format(os.path.join(root, reldir), e))
+            continue
+        subdirs = []
+        for entry in entries:
+            relpath = os.path.join(reldir, entry.name) if reldir else entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if not matcher.excluded(relpath, is_dir=True):
+                    subdirs.append(relpath)
+            elif entry.is_file() and not matcher.excluded(relpath):
+                yield relpath, entry.stat().st_size
+        # popped last-in first-out, so push in reverse to visit in order
+        stack.extend(reversed(subdirs))
+
+
+def summarize(root, matcher):
+    """ Returns (number of files, total bytes) that walk() would ship """
+    files = size = 0
+    for _, file_size in walk(root, matcher):
+        files += 1
+        size += file_size
+    return files, size
+
+
+def format_summary(files, size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024.0
+    return "{} files, {:.1f}{}".format(files, size, unit)
+
+
+@contextlib.contextmanager
+def files_from(root, matcher):
+    """ Yields the path of a temporary file listing every file walk() finds,
+    for rsync's --files-from """
+    with tempfile.NamedTemporaryFile("w", suffix=".files") as f:
+        for relpath, _ in walk(root, matcher):
+            f.write(relpath + "\n")
+        f.flush()
+        yield f.name
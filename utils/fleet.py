@@ -0,0 +1,212 @@
+import time
+import datetime
+from concurrent import futures
+
+from botocore.exceptions import ClientError
+
+from . import clients
+from . import registry
+from . import price_store
+
+# What we pay for, when working out what an instance has cost so far
+PRODUCT_DESCRIPTION = 'Linux/UNIX'
+
+# Spot request status codes meaning AWS is taking the instance back, or has
+INTERRUPTION_CODES = ('marked-for-termination', 'marked-for-stop', 'marked-for-hibernation',
+                      'instance-terminated-by-price', 'instance-terminated-no-capacity',
+                      'instance-terminated-capacity-oversubscribed',
+                      'instance-terminated-launch-group-constraint')
+
+# Instance states we don't need to keep an eye on
+GONE_STATES = ('shutting-down', 'terminated', 'stopping', 'stopped')
+
+
+class InstanceStatus():
+    """ What AWS says about one registered instance right now """
+
+    def __init__(self, record):
+        self.record = record
+        self.state = None
+        self.spot_status = record.get('spot_status')
+        self.instance_id = record.get('instance_id')
+        self.ip = record.get('ip')
+        self.launched_at = record.get('launched_at')
+        self.spot_price = None
+        self.cost = None
+        self.error = None
+
+    @property
+    def active(self):
+        """ Whether the instance is (or is about to be) running, and costing us """
+        return self.state in ('pending', 'running')
+
+    @property
+    def interrupted(self):
+        """ Whether AWS is reclaiming (or has reclaimed) the instance """
+        return self.spot_status in INTERRUPTION_CODES
+
+    @property
+    def uptime(self):
+        """ Seconds since the instance launched, or None if it isn't running """
+        if not self.active or self.launched_at is None:
+            return None
+        return max(0, time.time() - self.launched_at)
+
+
+# How many IDs go in one filter
+FILTER_CHUNK = 200
+
+
+def _describe_by_id(method, result_key, filter_name, ids):
+    """ Yields what a describe call returns for `ids`, following NextToken.
+
+    The IDs are passed as a filter rather than as SpotInstanceRequestIds or
+    InstanceIds: with those, one ID AWS no longer knows about (e.g. long
+    terminated) fails the whole call with a NotFound error, and nothing in
+    the region gets refreshed. A filter just leaves unknown IDs out.
+    """
+    for i in range(0, len(ids), FILTER_CHUNK):
+        kwargs = {'Filters': [{'Name': filter_name, 'Values': ids[i:i + FILTER_CHUNK]}]}
+        while True:
+            response = method(**kwargs)
+            for item in response.get(result_key, []):
+                yield item
+            next_token = response.get('NextToken')
+            if not next_token:
+                break
+            kwargs['NextToken'] = next_token
+
+
+def _describe_requests(client, statuses):
+    by_request = dict((s.record['spot_instance_request_id'], s) for s in statuses)
+    try:
+        requests = list(_describe_by_id(client.describe_spot_instance_requests,
+                                        'SpotInstanceRequests', 'spot-instance-request-id',
+                                        list(by_request)))
+    except ClientError as e:
+        for s in statuses:
+            s.error = str(e)
+        return
+    for request in requests:
+        s = by_request.get(request['SpotInstanceRequestId'])
+        if s is None:
+            continue
+        s.spot_status = request.get('Status', {}).get('Code')
+        s.instance_id = s.instance_id or request.get('InstanceId')
+
+
+def _describe_instances(client, statuses):
+    by_instance = dict((s.record['instance_id'], s) for s in statuses)
+    try:
+        reservations = list(_describe_by_id(client.describe_instances, 'Reservations',
+                                            'instance-id', list(by_instance)))
+    except ClientError as e:
+        for s in statuses:
+            s.error = str(e)
+        return
+    for reservation in reservations:
+        for instance in reservation.get('Instances', []):
+            s = by_instance.get(instance['InstanceId'])
+            if s is None:
+                continue
+            s.state = instance.get('State', {}).get('Name')
+            s.ip = instance.get('PublicIpAddress') or s.ip
+            if instance.get('LaunchTime'):
+                s.launched_at = instance['LaunchTime'].timestamp()
+
+
+def _describe_prices(client, statuses):
+    """ Looks up the current spot price of every instance in the region """
+    try:
+        # a StartTime of now returns the price in effect right now
+        response = client.describe_spot_price_history(
+            StartTime=datetime.datetime.now(datetime.timezone.utc),
+            InstanceTypes=sorted(set(s.record['instance_type'] for s in statuses)),
+            ProductDescriptions=[PRODUCT_DESCRIPTION])
+    except ClientError as e:
+        print(">> Couldn't get spot prices: {}".format(e))
+        return
+    prices = dict(((r['AvailabilityZone'], r['InstanceType']), float(r['SpotPrice']))
+                  for r in response.get('SpotPriceHistory', []))
+    for s in statuses:
+        s.spot_price = prices.get((s.record['az_zone'], s.record['instance_type']))
+
+
+def estimate_cost(store, status, now=None):
+    """ Roughly what an instance has cost since it launched: its spot price
+    history from the price store, integrated over its uptime, each price
+    holding from its record's timestamp until the next one. Time before the
+    first record the store has is charged at the current spot price. Returns
+    None if we don't know when it launched or what it costs. """
+    now = now or time.time()
+    if status.launched_at is None or status.spot_price is None:
+        return None
+    # oldest first, starting with the record in effect when it launched
+    records = list(store.iter_prices(status.record['az_zone'],
+                                     [status.record['instance_type']],
+                                     [PRODUCT_DESCRIPTION],
+                                     since=status.launched_at))[::-1]
+    cost = 0.0
+    start = status.launched_at
+    price = status.spot_price
+    for ts, record_price in records:
+        if ts > start:
+            cost += price * (min(ts, now) - start) / 3600
+            start = ts
+        price = record_price
+    cost += price * max(0, now - start) / 3600
+    return cost
+
+
+def refresh_fleet(records):
+    """ Asks AWS for the state of every registered instance in `records`.
+
+    Every region gets one describe_spot_instance_requests, one
+    describe_instances and one describe_spot_price_history call (more for
+    very large fleets), and all of them, for every region, are made at once,
+    so refreshing a fleet takes about one round trip. Returns an InstanceStatus for each record, in order.
+    """
+    statuses = [InstanceStatus(record) for record in records]
+    by_region = {}
+    for s in statuses:
+        by_region.setdefault(s.record['region'], []).append(s)
+
+    calls = []
+    for region, region_statuses in by_region.items():
+        client = clients.get_client('ec2', region)
+        with_requests = [s for s in region_statuses if s.record['spot_instance_request_id']]
+        with_instances = [s for s in region_statuses if s.record['instance_id']]
+        if with_requests:
+            calls.append((_describe_requests, client, with_requests))
+        if with_instances:
+            calls.append((_describe_instances, client, with_instances))
+        calls.append((_describe_prices, client, region_statuses))
+
+    if calls:
+        with futures.ThreadPoolExecutor(max_workers=len(calls)) as executor:
+            # list() so unexpected errors are raised here
+            list(executor.map(lambda call: call[0](*call[1:]), calls))
+
+    store = price_store.PriceStore()
+    for s in statuses:
+        if s.state is None and s.instance_id and not s.record['instance_id']:
+            # the request was only just fulfilled, so we didn't ask about
+            # its instance. It'll be picked up next time.
+            s.state = 'pending'
+        if s.active:
+            s.cost = estimate_cost(store, s)
+    return statuses
+
+
+def update_registry(statuses, instance_registry=None):
+    """ Writes what refresh_fleet found back into the registry """
+    instance_registry = instance_registry or registry.InstanceRegistry()
+    for s in statuses:
+        fields = {'spot_status': s.spot_status,
+                  'instance_id': s.instance_id,
+                  'ip': s.ip,
+                  'launched_at': s.launched_at,
+                  'spot_price': s.spot_price}
+        if s.state is not None:
+            fields['status'] = s.state
+        instance_registry.update(s.record['config_name'], s.record['n'], **fields)
@@ -0,0 +1,87 @@
+# Local table of what each instance type gives you, so prices of different
+# instance types can be compared per unit of compute.
+# Add rows here for any instance type you put in INSTANCE_TYPES that is missing.
+
+# instance type: (vCPUs, memory in GiB, GPUs)
+CAPABILITIES = {
+    't3.medium': (2, 4, 0),
+    'm4.large': (2, 8, 0),
+    'm4.xlarge': (4, 16, 0),
+    'm4.2xlarge': (8, 32, 0),
+    'm4.4xlarge': (16, 64, 0),
+    'm4.10xlarge': (40, 160, 0),
+    'm4.16xlarge': (64, 256, 0),
+    'm5.large': (2, 8, 0),
+    'm5.xlarge': (4, 16, 0),
+    'm5.2xlarge': (8, 32, 0),
+    'm5.4xlarge': (16, 64, 0),
+    'm5.12xlarge': (48, 192, 0),
+    'm5.24xlarge': (96, 384, 0),
+    'c4.large': (2, 3.75, 0),
+    'c4.xlarge': (4, 7.5, 0),
+    'c4.2xlarge': (8, 15, 0),
+    'c4.4xlarge': (16, 30, 0),
+    'c4.8xlarge': (36, 60, 0),
+    'c5.large': (2, 4, 0),
+    'c5.xlarge': (4, 8, 0),
+    'c5.2xlarge': (8, 16, 0),
+    'c5.4xlarge': (16, 32, 0),
+    'c5.9xlarge': (36, 72, 0),
+    'c5.18xlarge': (72, 144, 0),
+    'r4.large': (2, 15.25, 0),
+    'r4.xlarge': (4, 30.5, 0),
+    'r4.2xlarge': (8, 61, 0),
+    'r4.4xlarge': (16, 122, 0),
+    'r4.8xlarge': (32, 244, 0),
+    'r4.16xlarge': (64, 488, 0),
+    'r5.large': (2, 16, 0),
+    'r5.xlarge': (4, 32, 0),
+    'r5.2xlarge': (8, 64, 0),
+    'r5.4xlarge': (16, 128, 0),
+    'r5.12xlarge': (48, 384, 0),
+    'r5.24xlarge': (96, 768, 0),
+    'x1.16xlarge': (64, 976, 0),
+    'x1.32xlarge': (128, 1952, 0),
+    'g2.2xlarge': (8, 15, 1),
+    'g2.8xlarge': (32, 60, 4),
+    'g3.4xlarge': (16, 122, 1),
+    'g3.8xlarge': (32, 244, 2),
+    'g3.16xlarge': (64, 488, 4),
+    'p2.xlarge': (4, 61, 1),
+    'p2.8xlarge': (32, 488, 8),
+    'p2.16xlarge': (64, 732, 16),
+    'p3.2xlarge': (8, 61, 1),
+    'p3.8xlarge': (32, 244, 4),
+    'p3.16xlarge': (64, 488, 8),
+}
+
+
+def compute_units(instance_type, weights):
+    """ Returns the compute units of an instance type, given weights for
+    'vcpu', 'memory_gib' and 'gpus'. Returns None for unknown types.
+    """
+    if instance_type not in CAPABILITIES:
+        return None
+    vcpu, memory_gib, gpus = CAPABILITIES[instance_type]
+    return (weights.get('vcpu', 0) * vcpu +
+            weights.get('memory_gib', 0) * memory_gib +
+            weights.get('gpus', 0) * gpus)
+
+
+def compute_units_by_type(instance_types, weights):
+    """ Returns {instance_type: compute units} for the types we can rank.
+
+    With a single instance type there is nothing to compare, so it always gets
+    one unit. Otherwise, types missing from CAPABILITIES (or with no weighted
+    capability) are left out.
+    """
+    if len(instance_types) == 1:
+        return {instance_types[0]: 1.0}
+    units = {}
+    for instance_type in instance_types:
+        type_units = compute_units(instance_type, weights)
+        if not type_units:
+            print(">> No capabilities known for {}, not ranking it".format(instance_type))
+            continue
+        units[instance_type] = float(type_units)
+    return units
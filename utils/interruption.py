@@ -0,0 +1,101 @@
+""" Watches for spot interruption notices from on the instance, and pushes the
+output directory to S3 before the instance goes away.
+
+It runs beside the lab rather than inside its environment: notices are read
+from the metadata service with urllib, and the push is done by the aws cli, so
+it has no requirements of its own. To try it locally, point
+--metadata-url at a stand-in that answers like the instance metadata service
+does, e.g. one that returns a JSON body for
+/latest/meta-data/spot/instance-action.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+DEFAULT_METADATA_URL = 'http://169.254.169.254'
+INSTANCE_ACTION_PATH = '/latest/meta-data/spot/instance-action'
+TOKEN_PATH = '/latest/api/token'
+
+
+def _metadata_token(metadata_url, timeout):
+    """ Returns an IMDSv2 session token, or None if the endpoint only speaks
+    IMDSv1 """
+    request = urllib.request.Request(metadata_url + TOKEN_PATH, method='PUT',
+                                     headers={'X-aws-ec2-metadata-token-ttl-seconds': '21600'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read().decode('utf-8')
+    except urllib.error.URLError:
+        return None
+
+
+def pending_interruption(metadata_url=DEFAULT_METADATA_URL, timeout=2):
+    """ Returns the interruption notice ({'action': 'terminate', 'time': ...})
+    if the instance is about to be reclaimed, or None. """
+    token = _metadata_token(metadata_url, timeout)
+    headers = {'X-aws-ec2-metadata-token': token} if token else {}
+    request = urllib.request.Request(metadata_url + INSTANCE_ACTION_PATH, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        # 404 until there's a notice
+        if e.code == 404:
+            return None
+        raise
+
+
+def checkpoint(output_dir, destination):
+    """ Copies whatever in `output_dir` isn't already at the S3 `destination` """
+    cmd = ["aws", "s3", "sync", output_dir, destination]
+    print(">> {}".format(" ".join(cmd)))
+    sys.stdout.flush()
+    return subprocess.call(cmd)
+
+
+def watch(output_dir, destination, metadata_url=DEFAULT_METADATA_URL,
+          interval=5, checkpoint_interval=None):
+    """ Polls for an interruption notice every `interval` seconds. When one
+    comes, the output directory is pushed to S3 straight away, and we stop.
+
+    If `checkpoint_interval` is given, the output is also pushed that often
+    while we wait, so there's little left to copy in the two minutes a notice
+    gives us. """
+    last_checkpoint = time.time()
+    while True:
+        try:
+            notice = pending_interruption(metadata_url)
+        except Exception as e:
+            print(">> Couldn't reach the metadata service: {}".format(e))
+            notice = None
+        if notice is not None:
+            print(">> Interruption notice: {}".format(notice))
+            status = checkpoint(output_dir, destination)
+            # a second pass picks up anything written during the first
+            if status == 0:
+                status = checkpoint(output_dir, destination)
+            return status
+        if checkpoint_interval and time.time() - last_checkpoint > checkpoint_interval:
+            checkpoint(output_dir, destination)
+            last_checkpoint = time.time()
+        time.sleep(interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("output_dir")
+    parser.add_argument("destination", help="S3 URL to push the output directory to")
+    parser.add_argument("--metadata-url", default=DEFAULT_METADATA_URL)
+    parser.add_argument("--interval", type=float, default=5)
+    parser.add_argument("--checkpoint-interval", type=float, default=None)
+    args = parser.parse_args(argv)
+    return watch(args.output_dir, args.destination, args.metadata_url,
+                 args.interval, args.checkpoint_interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -52,6 +52,17 @@ def _find_config(name):
     else:
         return None
 
+def _write_atomically(path, dump, mode="w"):
+    """Writes a cache file by calling dump(f) on a temporary file next to it,
+    then moving that into place, so readers never see it half written.
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, mode) as f:
+        dump(f)
+    os.replace(tmp_path, path)
+
 def _find_inventory(name):
     return os.path.join(_custom_path(), "ansible", "{}_hosts".format(name))
 
@@ -61,8 +72,18 @@ def _load_module_from_path(name, path):
     foo = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(foo)
 
+def _with_defaults(conf):
+    """Fills in any setting the config doesn't define from configs/default.py,
+    so configs written before a setting was added keep working.
+    """
+    from ..configs import default
+    for key in dir(default):
+        if key.isupper() and not hasattr(conf, key):
+            setattr(conf, key, getattr(default, key))
+    return conf
+
 def _load_config(name):
     import sys
     sys.path.append(_custom_path())
     path = _find_config(name)
-    return __import__(name)
+    return _with_defaults(__import__(name))
@@ -0,0 +1,72 @@
+import collections
+import threading
+import time
+from concurrent import futures
+
+# A named step of a pipeline. `fn` is called with the item being processed.
+Stage = collections.namedtuple("Stage", ["name", "fn"])
+
+
+class PipelineRun():
+    """ What happened when running a pipeline over many items """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.succeeded = []
+        # {item: (stage name, exception)}
+        self.failed = {}
+        # {stage name: [seconds, ...]}
+        self.timings = collections.OrderedDict((stage.name, []) for stage in stages)
+        self._lock = threading.Lock()
+
+    def _record(self, stage, seconds):
+        with self._lock:
+            self.timings[stage.name].append(seconds)
+
+    def print_summary(self):
+        print(">> Stage timings (seconds):")
+        print("   {:<20} {:>5} {:>8} {:>8} {:>8} {:>6}".format(
+            "stage", "n", "min", "median", "max", "failed"))
+        failures = collections.Counter(stage for stage, _ in self.failed.values())
+        for name, seconds in self.timings.items():
+            if seconds:
+                ordered = sorted(seconds)
+                row = (len(ordered), ordered[0], ordered[len(ordered) // 2], ordered[-1])
+            else:
+                row = (0, 0, 0, 0)
+            print("   {:<20} {:>5} {:>8.1f} {:>8.1f} {:>8.1f} {:>6}".format(
+                name, *(row + (failures[name],))))
+
+
+def run_pipelines(items, stages, max_workers, label=str):
+    """ Runs every stage, in order, for each item. Items are processed
+    concurrently, at most `max_workers` at a time.
+
+    A stage raising only stops the pipeline of the item it was working on: its
+    remaining stages are skipped and the failure is recorded. Returns a
+    PipelineRun with the items that made it through every stage (in their
+    original order), the failures, and how long each stage took.
+    """
+    run = PipelineRun(stages)
+
+    def process(item):
+        for stage in stages:
+            start = time.time()
+            try:
+                stage.fn(item)
+            except Exception as e:
+                print(">> {} failed at '{}': {}".format(label(item), stage.name, e))
+                return stage.name, e
+            finally:
+                run._record(stage, time.time() - start)
+        return None
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        outcomes = list(executor.map(process, items))
+
+    for item, failure in zip(items, outcomes):
+        if failure is None:
+            run.succeeded.append(item)
+        else:
+            run.failed[item] = failure
+    return run
@@ -0,0 +1,117 @@
+import time
+from concurrent import futures
+
+from botocore.exceptions import ClientError
+
+from configs import default as uconf
+
+# Seconds to wait between polls. The last one repeats until we time out.
+BACKOFF_SCHEDULE = (1, 2, 3, 5, 8, 13)
+
+# AWS is eventually consistent, so requests and instances we just created can
+# briefly be unknown to it
+_NOT_FOUND_CODES = ('InvalidSpotInstanceRequestID.NotFound', 'InvalidInstanceID.NotFound')
+
+
+def _not_yet_visible(error):
+    return error.response.get('Error', {}).get('Code') in _NOT_FOUND_CODES
+
+
+class SpotRequestPoller():
+    """ Waits for many spot requests at once.
+
+    Each round makes one describe_spot_instance_requests call and at most one
+    describe_instances call per region, for every outstanding instance in that
+    region, so API traffic grows with the number of regions rather than the
+    number of instances.
+    """
+
+    def __init__(self, instances, timeout=uconf.SERVER_TIMEOUT, schedule=BACKOFF_SCHEDULE):
+        self.instances = list(instances)
+        self.timeout = timeout
+        self.schedule = schedule
+        # {AWSSpotInstance: reason}
+        self.failed = {}
+
+    def _by_region(self, instances):
+        by_region = {}
+        for si in instances:
+            by_region.setdefault(si.region, []).append(si)
+        return by_region
+
+    def _poll_region(self, region_instances):
+        client = region_instances[0].client
+
+        waiting_on_request = [si for si in region_instances if not si.instance_id]
+        if waiting_on_request:
+            try:
+                response = client.describe_spot_instance_requests(
+                    SpotInstanceRequestIds=[si.spot_instance_request_id for si in waiting_on_request])
+            except ClientError as e:
+                if not _not_yet_visible(e):
+                    raise
+                response = {}
+            requests = dict((r['SpotInstanceRequestId'], r)
+                            for r in response.get('SpotInstanceRequests', []))
+            for si in waiting_on_request:
+                request = requests.get(si.spot_instance_request_id)
+                if request is None:
+                    continue
+                si.status_code = request.get('Status', {}).get('Code')
+                si.instance_id = request.get('InstanceId')
+                if not si.instance_id and 'pending' not in (si.status_code or ''):
+                    self.failed[si] = "Spot constraints can't be met: {}".format(si.status_code)
+
+        waiting_on_ip = [si for si in region_instances
+                         if si.instance_id and not si.ip and si not in self.failed]
+        if waiting_on_ip:
+            try:
+                response = client.describe_instances(
+                    InstanceIds=[si.instance_id for si in waiting_on_ip])
+            except ClientError as e:
+                if not _not_yet_visible(e):
+                    raise
+                response = {}
+            ips = {}
+            for reservation in response.get('Reservations', []):
+                for instance in reservation.get('Instances', []):
+                    ips[instance['InstanceId']] = instance.get('PublicIpAddress')
+            for si in waiting_on_ip:
+                si.ip = ips.get(si.instance_id)
+
+    def outstanding(self):
+        return [si for si in self.instances if not si.ip and si not in self.failed]
+
+    def poll(self):
+        """ Polls every region with outstanding instances once, concurrently """
+        by_region = self._by_region(self.outstanding())
+        if not by_region:
+            return
+        with futures.ThreadPoolExecutor(max_workers=len(by_region)) as executor:
+            # list() so errors from any region are raised here
+            list(executor.map(self._poll_region, by_region.values()))
+
+    def wait(self):
+        """ Polls until every instance has an IP, has failed, or we time out.
+        Returns (ready, failed), where failed is {instance: reason}.
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            self.poll()
+            outstanding = self.outstanding()
+            if not outstanding:
+                break
+            elapsed = time.time() - start
+            if elapsed > self.timeout:
+                for si in outstanding:
+                    self.failed[si] = "Timed out waiting for an IP (status: {})".format(si.status_code)
+                break
+            wait = self.schedule[min(attempt, len(self.schedule) - 1)]
+            print(">> Waiting on {} of {} instances, polling again in {}s".format(
+                len(outstanding), len(self.instances), wait))
+            time.sleep(min(wait, max(0, self.timeout - elapsed)))
+            attempt += 1
+
+        ready = [si for si in self.instances if si.ip and si not in self.failed]
+        return ready, dict(self.failed)
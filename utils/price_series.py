@@ -0,0 +1,119 @@
+import array
+import numpy as np
+
+
+class PriceSeries():
+    """ Spot prices of one AZ as compact arrays (int64 epoch timestamps and
+    float32 prices), newest first.
+
+    Stats are computed once, on first use, or for many series at once by
+    score_series.
+    """
+
+    def __init__(self, timestamps, prices):
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.prices = np.asarray(prices, dtype=np.float32)
+        if len(self.timestamps) > 1 and np.any(np.diff(self.timestamps) > 0):
+            order = np.argsort(-self.timestamps, kind='mergesort')
+            self.timestamps = self.timestamps[order]
+            self.prices = self.prices[order]
+        self._mean = None
+        self._variance = None
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds a series from an iterable of (timestamp, price) rows,
+        without materialising the rows as a list."""
+        timestamps = array.array('q')
+        prices = array.array('f')
+        for timestamp, price in rows:
+            timestamps.append(int(timestamp))
+            prices.append(price)
+        return cls(np.frombuffer(timestamps, dtype=np.int64),
+                   np.frombuffer(prices, dtype=np.float32))
+
+    def __len__(self):
+        return len(self.prices)
+
+    @property
+    def count(self):
+        return len(self.prices)
+
+    def _compute_stats(self):
+        if self.count == 0:
+            self._mean, self._variance = float('nan'), float('nan')
+        else:
+            prices = self.prices.astype(np.float64)
+            self._mean = float(prices.mean())
+            self._variance = float(prices.var())
+
+    @property
+    def mean(self):
+        if self._mean is None:
+            self._compute_stats()
+        return self._mean
+
+    @property
+    def variance(self):
+        """ Population variance, same as np.var """
+        if self._variance is None:
+            self._compute_stats()
+        return self._variance
+
+    @property
+    def current_price(self):
+        if self.count == 0:
+            return None
+        return float(self.prices[0])
+
+
+def score(current_price, mean, variance, bid):
+    """ Scores a spot price series. Works on scalars or numpy arrays. """
+    # Here we multiply each item by a weight.
+    # These weights are arbitrary and probably not ideal.
+    # There is much room for improvement on this scoring algorithm, but this algorithm
+    # works for most light use cases. Feel free to contribute!
+    current_price_s = bid - current_price
+    variance_s = -5 * (variance * mean)
+    mean_s = 0.5 * (bid - mean)
+    return current_price_s + variance_s + mean_s
+
+
+def score_series(series, bid, units=None):
+    """ Scores many price series in one numpy pass, filling in each series'
+    cached stats along the way. Returns an array of scores, in order.
+
+    If `units` is given, series i is ranked on its price per unit of compute,
+    i.e. with its prices divided by units[i]. The bid stays what it is: it's
+    what is paid for the whole instance, so it's only compared with the raw
+    current price, and series whose current price is over it score 0. Empty
+    series score -1e10. Same as Candidate.calculate_score.
+    """
+    n = len(series)
+    if n == 0:
+        return np.zeros(0)
+    units = np.ones(n) if units is None else np.asarray(units, dtype=np.float64)
+    counts = np.array([s.count for s in series], dtype=np.int64)
+    prices = np.concatenate([s.prices for s in series]).astype(np.float64)
+    segments = np.repeat(np.arange(n), counts)
+
+    has_data = counts > 0
+    safe_counts = np.where(has_data, counts, 1)
+    means = np.bincount(segments, weights=prices, minlength=n) / safe_counts
+    deviations = prices - means[segments]
+    variances = np.bincount(segments, weights=deviations * deviations, minlength=n) / safe_counts
+    means[~has_data] = np.nan
+    variances[~has_data] = np.nan
+
+    # Series are newest first, so the current price is the first of each segment
+    starts = np.cumsum(counts) - counts
+    current = np.full(n, np.nan)
+    current[has_data] = prices[starts[has_data]]
+
+    for s, mean, variance in zip(series, means, variances):
+        s._mean, s._variance = float(mean), float(variance)
+
+    with np.errstate(invalid='ignore'):
+        scores = score(current / units, means / units, variances / units ** 2, bid)
+        scores = np.where(current > bid, 0.0, scores)
+    return np.where(has_data, scores, -1e10)
@@ -0,0 +1,119 @@
+import os
+import time
+
+from . import paths
+from . import sqlite_util
+
+
+def default_store_path():
+    return os.path.join(paths._custom_path(), "spot_prices.sqlite")
+
+
+class PriceStore():
+    """ On-disk spot price history, keyed by region, AZ, instance type and
+    product description.
+
+    Every launch used to download the full 7 day window for every AZ. With the
+    store, we only ask AWS for records newer than the last complete fetch.
+    Connections are opened per call, so one store can be shared between
+    threads.
+    """
+
+    def __init__(self, path=None):
+        self.path = sqlite_util.open_database(path or default_store_path())
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS prices (
+                                region TEXT NOT NULL,
+                                az TEXT NOT NULL,
+                                instance_type TEXT NOT NULL,
+                                product TEXT NOT NULL,
+                                ts INTEGER NOT NULL,
+                                price REAL NOT NULL,
+                                PRIMARY KEY (az, instance_type, product, ts))""")
+            conn.execute("""CREATE INDEX IF NOT EXISTS prices_region
+                            ON prices (region, instance_type, product, ts)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS fetches (
+                                region TEXT NOT NULL,
+                                instance_type TEXT NOT NULL,
+                                product TEXT NOT NULL,
+                                fetched_at INTEGER NOT NULL,
+                                PRIMARY KEY (region, instance_type, product))""")
+
+    def _connect(self):
+        return sqlite_util.connect(self.path)
+
+    def add_records(self, region, records):
+        """ Stores boto spot price history records, in one short transaction.
+        Records we already have are ignored. `records` is read before the
+        transaction starts, so a generator that fetches them over the network
+        doesn't hold the write lock while it waits.
+        """
+        rows = [(region,
+                 record['AvailabilityZone'],
+                 record['InstanceType'],
+                 record['ProductDescription'],
+                 int(record['Timestamp'].timestamp()),
+                 float(record['SpotPrice'])) for record in records]
+        with self._connect() as conn:
+            conn.executemany("""INSERT OR IGNORE INTO prices
+                                (region, az, instance_type, product, ts, price)
+                                VALUES (?, ?, ?, ?, ?, ?)""", rows)
+
+    def mark_fetched(self, region, instance_types, products, fetched_at=None):
+        fetched_at = int(fetched_at or time.time())
+        with self._connect() as conn:
+            conn.executemany("""INSERT OR REPLACE INTO fetches
+                                (region, instance_type, product, fetched_at)
+                                VALUES (?, ?, ?, ?)""",
+                             [(region, instance_type, product, fetched_at)
+                              for instance_type in instance_types
+                              for product in products])
+
+    def last_fetched(self, region, instance_types, products):
+        """ Returns when the given instance types and products were last all
+        fetched for this region (epoch seconds), or None if never.
+        """
+        fetched = []
+        with self._connect() as conn:
+            for instance_type in instance_types:
+                for product in products:
+                    row = conn.execute("""SELECT fetched_at FROM fetches
+                                          WHERE region = ? AND instance_type = ? AND product = ?""",
+                                       (region, instance_type, product)).fetchone()
+                    if row is None:
+                        return None
+                    fetched.append(row[0])
+        return min(fetched) if fetched else None
+
+    def iter_prices(self, az, instance_types, products, since, limit=None):
+        """ Yields (timestamp, price) for an AZ, newest first, from `since`
+        (epoch seconds) onwards, plus the record that was in effect at `since`
+        (the newest one at or before it). A price only gets a record when it
+        changes, so without that record a price that has held for longer than
+        the window would have no history at all.
+        """
+        filters = "az = ? AND instance_type IN ({}) AND product IN ({})".format(
+            ",".join("?" * len(instance_types)), ",".join("?" * len(products)))
+        filter_params = [az] + list(instance_types) + list(products)
+        query = """SELECT ts, price FROM prices
+                   WHERE {0} AND ts >= COALESCE(
+                       (SELECT MAX(ts) FROM prices WHERE {0} AND ts <= ?), ?)
+                   ORDER BY ts DESC""".format(filters)
+        params = filter_params + filter_params + [int(since), int(since)]
+        if limit:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        with self._connect() as conn:
+            for row in conn.execute(query, params):
+                yield row
+
+    def prune(self, before):
+        """ Drops records older than `before` (epoch seconds), except the one
+        still in effect at `before` for each AZ, instance type and product. """
+        with self._connect() as conn:
+            conn.execute("""DELETE FROM prices WHERE ts < ? AND ts < (
+                                SELECT MAX(newer.ts) FROM prices AS newer
+                                WHERE newer.az = prices.az
+                                AND newer.instance_type = prices.instance_type
+                                AND newer.product = prices.product
+                                AND newer.ts <= ?)""", (int(before), int(before)))
@@ -1,87 +1,237 @@
 from operator import attrgetter
+from concurrent import futures
 import os
 import pickle
-import datetime
-import boto3
+import time
 
 from . import az_zone
+from . import price_store
+from . import instance_types as instance_types_util
+from . import paths
+from . import clients
 from .. import configs
 from configs import default as uconf
 #import aws_spot_bot.user_config as uconf
 
 
-def modification_date(filename):
-    t = os.path.getmtime(filename)
-    return datetime.datetime.fromtimestamp(t)
-
-
-def generate_region_AZ_dict():
-    """ Generates a dict of {'region': [availability_zones, az2]} """
-    print("Getting all regions and AZ's... (this may take some time)")
-    region_az = {}
-    # print('"{}"'.format(uconf.AWS_ACCESS_KEY_ID))
-    # print('"{}"'.format(uconf.AWS_ACCESS_KEY_ID.strip()))
-    for region in uconf.AWS_REGIONS:
-        ec2 = boto3.client('ec2',
-                           region_name=region)
-        #print(ec2.describe_hosts())
-        avail_zones = []
-        #print(ec2.describe_availability_zones())
-        for zone in ec2.describe_availability_zones()['AvailabilityZones']:
-            if zone['State'] == 'available':
-                avail_zones.append(zone['ZoneName'])
-        region_az[region] = avail_zones
-        print(">>", region)
-
-    return region_az
-
-
-def get_initialized_azs():
-    az_pickle_fn = "az_dict.pickle"
-    az_objects_fn = 'az_objs_list.pickle'
-    last_valid_AZ_time = datetime.datetime.now() - datetime.timedelta(days=uconf.AZ_PICKLE_EXPIRE_TIME_DAYS)
-    last_valid_spot_time = datetime.datetime.now() - datetime.timedelta(seconds=uconf.SPOT_PRICING_PICKLE_EXPIRE_SEC)
-
-    # Loads AZs from pickle if it exists and is less than 30 days old, else fetches them
-    if os.path.isfile(az_pickle_fn) and modification_date(az_pickle_fn) > last_valid_AZ_time:
-        az_dict = pickle.load(open(az_pickle_fn, "rb"))
-    else:
-        az_dict = generate_region_AZ_dict()
-        print("dumping to file...")
-        pickle.dump(az_dict, open(az_pickle_fn, "wb"))
-
-    # Loads AZs from pickle if it exists and is less than 30 days old, else fetches them
-    if False and os.path.isfile(az_objects_fn) and modification_date(az_objects_fn) > last_valid_spot_time:
-        az_objects = pickle.load(open(az_objects_fn, "rb"))
-    else:
-        az_objects = []
-        # Get the spot pricing for each AZ
-        print("getting spot pricing...")
-        for region, azs in az_dict.items():
-            print(region, azs)
-            for az in azs:
-                az_obj = az_zone.AZZone(region, az)
-                az_objects.append(az_obj)
-
-        # pickle.dump(az_objects, open(az_objects_fn, "wb"))
+# Bump this whenever the layout of the topology cache changes
+TOPOLOGY_CACHE_VERSION = 1
+
+
+def _topology_cache_path():
+    return os.path.join(paths._custom_path(), "az_topology.pickle")
+
+
+def discover_regions():
+    """ Returns the names of every region this account can use """
+    ec2 = clients.get_client('ec2', 'us-east-1')
+    return sorted(region['RegionName'] for region in ec2.describe_regions()['Regions'])
+
+
+def get_region_azs(region):
+    """ Returns the available AZs of a region """
+    ec2 = clients.get_client('ec2', region)
+    avail_zones = []
+    for zone in ec2.describe_availability_zones()['AvailabilityZones']:
+        if zone['State'] == 'available':
+            avail_zones.append(zone['ZoneName'])
+    print(">>", region)
+    return avail_zones
+
+
+def generate_region_AZ_dict(regions=None):
+    """ Generates a dict of {'region': [availability_zones, az2]}, querying
+    all regions at once. If `regions` is None, every region is discovered with
+    describe_regions. """
+    print("Getting all regions and AZ's...")
+    if regions is None:
+        regions = discover_regions()
+    with futures.ThreadPoolExecutor(max_workers=max(1, len(regions))) as executor:
+        avail_zones = list(executor.map(get_region_azs, regions))
+    return dict(zip(regions, avail_zones))
+
+
+def _load_topology_cache():
+    path = _topology_cache_path()
+    if os.path.isfile(path):
+        try:
+            with open(path, "rb") as f:
+                cache = pickle.load(f)
+            if cache.get('version') == TOPOLOGY_CACHE_VERSION:
+                return cache
+        except Exception as e:
+            print(">> Ignoring unreadable AZ cache {}: {}".format(path, e))
+    return {'version': TOPOLOGY_CACHE_VERSION, 'entries': {}}
+
+
+def _save_topology_cache(cache):
+    paths._write_atomically(_topology_cache_path(), lambda f: pickle.dump(cache, f), "wb")
+
+
+def load_region_AZ_dict(regions=uconf.AWS_REGIONS,
+                        max_age_days=uconf.AZ_PICKLE_EXPIRE_TIME_DAYS):
+    """ Returns {'region': [availability_zones]} for the given regions (or
+    every region, if None) from the topology cache in ~/.lab_config, refreshing
+    it if it's missing or older than `max_age_days`.
+
+    The cache holds one entry per set of regions, so configs with different
+    AWS_REGIONS don't evict each other.
+    """
+    key = 'all' if regions is None else tuple(sorted(set(regions)))
+    cache = _load_topology_cache()
+    entry = cache['entries'].get(key)
+    if entry and entry['fetched_at'] > time.time() - max_age_days * 24 * 60 * 60:
+        return entry['region_azs']
+
+    region_azs = generate_region_AZ_dict(None if regions is None else list(key))
+    cache['entries'][key] = {'fetched_at': time.time(), 'region_azs': region_azs}
+    _save_topology_cache(cache)
+    return region_azs
+
+
+def get_initialized_azs(regions=uconf.AWS_REGIONS,
+                        max_age_days=uconf.AZ_PICKLE_EXPIRE_TIME_DAYS):
+    """ Returns an AZZone for every availability zone in the given regions (or
+    every region, if None). """
+    az_dict = load_region_AZ_dict(regions, max_age_days)
+
+    # Spot pricing itself is kept in the price store, and fetched incrementally
+    # by collect_spot_pricing.
+    az_objects = []
+    for region, azs in az_dict.items():
+        print(region, azs)
+        for az in azs:
+            az_obj = az_zone.AZZone(region, az)
+            az_objects.append(az_obj)
 
     return az_objects
 
 
-def get_best_az():
-    azs = get_initialized_azs()
+def collect_spot_pricing(azs, instance_types, product_descriptions=['Linux/UNIX'],
+                         deadline=uconf.PRICING_DEADLINE_SEC,
+                         max_age=uconf.SPOT_PRICING_PICKLE_EXPIRE_SEC,
+                         max_samples=uconf.SPOT_PRICING_MAX_SAMPLES):
+    """ Brings the price store up to date and loads stats for every AZ, one
+    query per region, with all regions queried in parallel.
+
+    Regions whose prices were fetched less than `max_age` seconds ago (say, by
+    `labbox prices watch`) are loaded straight from the store, without asking
+    AWS. AZs in regions that fail, or haven't answered `deadline` seconds after
+    we start, are scored on whatever the store already has for them (if
+    nothing, they rank last) instead of holding up the ranking.
+    """
+    store = price_store.PriceStore()
+    fresh_after = time.time() - max_age
+    by_region = {}
+    for az in azs:
+        by_region.setdefault(az.region, []).append(az)
+
+    for region in list(by_region):
+        last_fetched = store.last_fetched(region, instance_types, product_descriptions)
+        if last_fetched and last_fetched > fresh_after:
+            for az in by_region.pop(region):
+                az.load_from_store(store, instance_types, product_descriptions, max_samples)
+    if not by_region:
+        return azs
+
+    # Workers only return price series; AZs are only ever updated here, so a
+    # worker we stop waiting for can't change them under the ranking
+    executor = futures.ThreadPoolExecutor(max_workers=max(1, len(by_region)))
+    pending = {executor.submit(az_zone.fetch_region_spot_prices,
+                               region_azs, instance_types, product_descriptions,
+                               max_samples, store): region
+               for region, region_azs in by_region.items()}
+    done, not_done = futures.wait(pending, timeout=deadline)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future in done:
+        region = pending[future]
+        try:
+            price_series = future.result()
+            for az in by_region[region]:
+                az.price_series = price_series[az.name]
+        except Exception as e:
+            print(">> Failed to get spot prices for {}: {}".format(region, e))
+            for az in by_region[region]:
+                az.load_from_store(store, instance_types, product_descriptions, max_samples)
+    for future in not_done:
+        region = pending[future]
+        print(">> Timed out getting spot prices for {}".format(region))
+        for az in by_region[region]:
+            az.load_from_store(store, instance_types, product_descriptions, max_samples)
+
+    return azs
+
+
+def refresh_prices(conf=uconf):
+    """ Fetches the latest spot prices for the config's instance types into the
+    price store, whether or not the stored ones are still fresh. """
+    azs = get_initialized_azs(conf.AWS_REGIONS, conf.AZ_PICKLE_EXPIRE_TIME_DAYS)
+    collect_spot_pricing(azs, conf.INSTANCE_TYPES, deadline=conf.PRICING_DEADLINE_SEC,
+                         max_age=0, max_samples=conf.SPOT_PRICING_MAX_SAMPLES)
+    return azs
+
+
+def watch_prices(conf=uconf, interval=uconf.SPOT_PRICING_PICKLE_EXPIRE_SEC // 2):
+    """ Refreshes the price store every `interval` seconds, forever, so that
+    launches can rank from the store without waiting on AWS. A refresh that
+    fails is logged, and the next one goes ahead as usual. """
+    while True:
+        start = time.time()
+        try:
+            refresh_prices(conf)
+            print(">> Refreshed spot prices in {:.1f}s, next refresh in {}s".format(
+                time.time() - start, interval))
+        except Exception as e:
+            print(">> Failed to refresh spot prices: {!r}, retrying in {}s".format(e, interval))
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
+def rank_candidates(conf=uconf):
+    """ Scores every (AZ, instance type) pair on price per unit of compute,
+    in the AWS_REGIONS and using the INSTANCE_TYPES, BID and
+    COMPUTE_UNIT_WEIGHTS of the given config. Prices are fetched according to
+    its SPOT_PRICING_PICKLE_EXPIRE_SEC, PRICING_DEADLINE_SEC and
+    SPOT_PRICING_MAX_SAMPLES. Returns the candidates, best first.
+    """
+    azs = get_initialized_azs(conf.AWS_REGIONS, conf.AZ_PICKLE_EXPIRE_TIME_DAYS)
     print("Found {} AZs.".format(len(azs)))
+    collect_spot_pricing(azs, conf.INSTANCE_TYPES,
+                         deadline=conf.PRICING_DEADLINE_SEC,
+                         max_age=conf.SPOT_PRICING_PICKLE_EXPIRE_SEC,
+                         max_samples=conf.SPOT_PRICING_MAX_SAMPLES)
+
+    units_by_type = instance_types_util.compute_units_by_type(conf.INSTANCE_TYPES,
+                                                              conf.COMPUTE_UNIT_WEIGHTS)
+    candidates = []
     for az in azs:
-        az.calculate_score(uconf.INSTANCE_TYPES, 0.65)
+        candidates += az.candidates(units_by_type)
+    az_zone.score_candidates(candidates, conf.BID)
+
+    # Sort the candidates by score, best one first
+    return sorted(candidates, key=attrgetter('score'), reverse=True)
+
+
+def print_candidates(candidates):
+    """ Prints ranked candidates, worst first so the best ends up on screen """
+    for c in reversed(candidates):
+        print(c.az_name, c.instance_type)
+        print('>> price:', c.current_price)
+        print('>> mean:', c.spot_price_mean)
+        print('>> variance:', c.spot_price_variance)
+        print('>> price per unit:', c.price_per_unit)
+        print('>> score:', c.score)
+
 
-    # Sort the AZs by score and return the best one
-    sorted_azs = sorted(azs, key=attrgetter('score'))
+def launchable_candidates(candidates, max_price):
+    """ Returns the ranked candidates worth launching in: ones we have prices
+    for, whose current price is at or under `max_price`. """
+    return [c for c in candidates
+            if c.current_price is not None and c.current_price <= max_price]
 
-    for az in sorted_azs:
-        print(az.name)
-        print('>> price:', az.current_price)
-        print('>> mean:', az.spot_price_mean)
-        print('>> variance:', az.spot_price_variance)
-        print('>> score:', az.score)
 
-    return sorted_azs[-1]
+def get_best_az(conf=uconf):
+    """ Returns the best Candidate: the AZ and instance type to launch """
+    candidates = rank_candidates(conf)
+    print_candidates(candidates)
+    return candidates[0]
@@ -0,0 +1,180 @@
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+from configs import default as uconf
+
+# Error codes AWS uses to tell us to slow down
+THROTTLING_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                          'TooManyRequestsException', 'RequestThrottled', 'SlowDown')
+
+# Error codes for failures on AWS' side that are worth retrying as they are
+TRANSIENT_ERROR_CODES = ('InternalError', 'InternalFailure', 'ServiceUnavailable',
+                         'Unavailable', 'RequestTimeout', 'RequestTimeoutException')
+
+# Client methods that don't make requests, and so aren't rate limited
+_LOCAL_METHODS = ('can_paginate', 'get_paginator', 'get_waiter', 'generate_presigned_url',
+                  'generate_presigned_post')
+
+
+class TokenBucket():
+    """ Hands out `rate` tokens a second, up to `burst` at once.
+
+    The rate adapts: it is halved each time AWS throttles us, and creeps back
+    up towards `max_rate` with every successful call.
+    """
+
+    def __init__(self, max_rate, burst, min_rate=0.5):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.rate = float(max_rate)
+        self.burst = float(burst)
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        """ Blocks until a token is available, and takes it """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+class RetryBudget():
+    """ A pool of retries shared by every client, so a throttling storm can't
+    turn into unbounded retrying. Each successful call earns back a fraction
+    of a retry, up to the initial size of the pool.
+    """
+
+    def __init__(self, max_retries, refill_per_success=0.1):
+        self.max_retries = float(max_retries)
+        self.refill_per_success = refill_per_success
+        self._retries = float(max_retries)
+        self._lock = threading.Lock()
+
+    def try_spend(self):
+        with self._lock:
+            if self._retries < 1:
+                return False
+            self._retries -= 1
+            return True
+
+    def deposit(self):
+        with self._lock:
+            self._retries = min(self.max_retries, self._retries + self.refill_per_success)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+retry_budget = RetryBudget(uconf.EC2_RETRY_BUDGET)
+
+
+def get_bucket(region):
+    """ Returns the token bucket shared by every client talking to `region` """
+    with _buckets_lock:
+        if region not in _buckets:
+            _buckets[region] = TokenBucket(uconf.EC2_MAX_REQUESTS_PER_SEC,
+                                           uconf.EC2_REQUEST_BURST)
+        return _buckets[region]
+
+
+def _is_throttling(error):
+    return error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def _is_transient(error):
+    """ Whether a request failed for a reason that's likely gone by the next
+    try: a server error, a dropped connection or a timeout """
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    return (error.response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES or
+            error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+
+
+def _backoff(attempt, base=0.5, cap=20):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimitedClient():
+    """ Wraps a boto3 client so every request it makes waits on its region's
+    token bucket, and throttled or transiently failed requests (see
+    _is_transient) are retried with backoff while the shared retry budget
+    allows. Only throttling slows the bucket down.
+
+    Clients are built with botocore's own retries off (see clients.py), so
+    these are the only retries.
+    """
+
+    def __init__(self, client, region, max_attempts=8):
+        self._client = client
+        self._region = region
+        self._bucket = get_bucket(region)
+        self._max_attempts = max_attempts
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or name in _LOCAL_METHODS or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._call(name, attr, *args, **kwargs)
+        return call
+
+    def _call(self, name, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._bucket.acquire()
+            try:
+                result = method(*args, **kwargs)
+            except (ClientError, ConnectionError, HTTPClientError) as e:
+                throttled = isinstance(e, ClientError) and _is_throttling(e)
+                if not throttled and not _is_transient(e):
+                    raise
+                if throttled:
+                    self._bucket.throttled()
+                attempt += 1
+                if attempt >= self._max_attempts or not retry_budget.try_spend():
+                    raise
+                wait = _backoff(attempt)
+                if throttled:
+                    print(">> Throttled by {} in {}, retrying in {:.1f}s".format(
+                        name, self._region, wait))
+                else:
+                    print(">> {} in {} failed ({}), retrying in {:.1f}s".format(
+                        name, self._region, e, wait))
+                time.sleep(wait)
+                continue
+            self._bucket.succeeded()
+            retry_budget.deposit()
+            return result
+
+
+def limited_client(client, region=None):
+    """ Returns `client`, rate limited for its region """
+    if isinstance(client, RateLimitedClient):
+        return client
+    return RateLimitedClient(client, region or client.meta.region_name)
+
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+from configs import default as uconf
+
+# What we expect to be talking to on each port. Ports not listed here count
+# as ready as soon as they accept a connection.
+PORT_PROTOCOLS = {22: 'ssh', 80: 'http'}
+
+
+class ProbeResult():
+    """ The outcome of waiting for one port on one host """
+
+    def __init__(self, host, port, ready, ready_at=None, started_at=None, error=None):
+        self.host = host
+        self.port = port
+        self.ready = ready
+        self.ready_at = ready_at
+        self.started_at = started_at
+        self.error = error
+
+    @property
+    def seconds_to_ready(self):
+        """ Seconds from `started_at` (e.g. the launch) until the port was ready """
+        if not self.ready:
+            return None
+        return self.ready_at - self.started_at
+
+    def __repr__(self):
+        if self.ready:
+            return "{}:{} ready after {:.1f}s".format(self.host, self.port, self.seconds_to_ready)
+        return "{}:{} not ready ({})".format(self.host, self.port, self.error)
+
+
+async def _check(host, port, timeout):
+    """ Connects once, and checks the port is speaking the protocol we expect """
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        protocol = PORT_PROTOCOLS.get(port)
+        if protocol == 'ssh':
+            banner = await asyncio.wait_for(reader.readline(), timeout)
+            if not banner.startswith(b'SSH-'):
+                raise ConnectionError("no SSH banner")
+        elif protocol == 'http':
+            writer.write("HEAD / HTTP/1.0\r\nHost: {}\r\n\r\n".format(host).encode('ascii'))
+            await writer.drain()
+            status = await asyncio.wait_for(reader.readline(), timeout)
+            if not status.startswith(b'HTTP/'):
+                raise ConnectionError("no HTTP response")
+    finally:
+        writer.close()
+
+
+async def _probe(host, port, deadline, started_at, interval, connect_timeout):
+    loop = asyncio.get_running_loop()
+    error = None
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return ProbeResult(host, port, False, started_at=started_at,
+                               error=error or "timed out")
+        try:
+            await _check(host, port, min(connect_timeout, remaining))
+            return ProbeResult(host, port, True, ready_at=time.time(), started_at=started_at)
+        except (OSError, asyncio.TimeoutError) as e:
+            error = repr(e)
+        await asyncio.sleep(min(interval, max(0, deadline - loop.time())))
+
+
+async def _probe_all(targets, timeout, interval, connect_timeout):
+    loop = asyncio.get_running_loop()
+    # each target gives up `timeout` seconds from now, independently of the others
+    deadline = loop.time() + timeout
+    return await asyncio.gather(*[_probe(host, port, deadline, started_at, interval, connect_timeout)
+                                  for host, port, started_at in targets])
+
+
+def probe_hosts(targets, timeout=uconf.SERVER_TIMEOUT, interval=3, connect_timeout=5):
+    """ Waits for many (host, port, started_at) targets at once. `started_at`
+    is the epoch time readiness is measured from, or None for now.
+
+    Returns a ProbeResult for each target, in order.
+    """
+    now = time.time()
+    targets = [(host, port, started_at or now) for host, port, started_at in targets]
+    return asyncio.run(_probe_all(targets, timeout, interval, connect_timeout))
+
@@ -0,0 +1,128 @@
+import os
+import time
+import sqlite3
+
+from . import paths
+from . import sqlite_util
+
+# Everything we remember about a launched instance, in table order
+COLUMNS = ('config_name', 'n', 'region', 'az_zone', 'instance_type', 'ami_id',
+           'bid', 'key_name', 'security_group_id', 'security_group_name',
+           'group_name', 'random_id', 'spot_instance_request_id', 'instance_id',
+           'ip', 'status', 'spot_status', 'spot_price', 'launched_at', 'updated_at')
+
+
+def default_registry_path():
+    return os.path.join(paths._custom_path(), "instances.sqlite")
+
+
+class InstanceRegistry():
+    """ On-disk record of the instances we've launched, keyed by config name
+    and instance number (the CONF and N of `labbox run CONF N`).
+
+    Listing a fleet or looking an instance up only reads this file, it never
+    asks AWS. Every write is a single statement on a connection of its own,
+    which keeps writes atomic and lets launch threads save concurrently.
+    """
+
+    def __init__(self, path=None):
+        self.path = sqlite_util.open_database(path or default_registry_path())
+        with self._connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS instances (
+                                config_name TEXT NOT NULL,
+                                n INTEGER NOT NULL,
+                                region TEXT NOT NULL,
+                                az_zone TEXT NOT NULL,
+                                instance_type TEXT NOT NULL,
+                                ami_id TEXT,
+                                bid REAL,
+                                key_name TEXT,
+                                security_group_id TEXT,
+                                security_group_name TEXT,
+                                group_name TEXT,
+                                random_id TEXT,
+                                spot_instance_request_id TEXT,
+                                instance_id TEXT,
+                                ip TEXT,
+                                status TEXT,
+                                spot_status TEXT,
+                                spot_price REAL,
+                                launched_at REAL,
+                                updated_at REAL NOT NULL,
+                                PRIMARY KEY (config_name, n))""")
+
+    def _connect(self):
+        return sqlite_util.connect(self.path, sqlite3.Row)
+
+    def save(self, si, n, status):
+        """ Records an AWSSpotInstance as instance `n` of its config, replacing
+        whatever was recorded under that number before. """
+        record = {'config_name': si.config_name,
+                  'n': int(n),
+                  'region': si.region,
+                  'az_zone': si.az_zone,
+                  'instance_type': si.instance_type,
+                  'ami_id': si.ami_id,
+                  'bid': si.bid,
+                  'key_name': si.key_name,
+                  'security_group_id': si.security_group_id,
+                  'security_group_name': si.security_group_name,
+                  'group_name': si.group_name,
+                  'random_id': si.random_id,
+                  'spot_instance_request_id': si.spot_instance_request_id,
+                  'instance_id': si.instance_id,
+                  'ip': si.ip,
+                  'status': status,
+                  'spot_status': si.status_code,
+                  'spot_price': None,
+                  'launched_at': si.launched_at,
+                  'updated_at': time.time()}
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO instances ({}) VALUES ({})".format(
+                ", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                         [record[column] for column in COLUMNS])
+
+    def next_number(self, config_name):
+        """ Returns the number to give the next instance launched for a
+        config: one past the highest it has recorded, so a relaunch doesn't
+        take over the numbers (and rows) of instances still running. """
+        with self._connect() as conn:
+            row = conn.execute("SELECT MAX(n) AS n FROM instances WHERE config_name = ?",
+                               (config_name,)).fetchone()
+        return 0 if row['n'] is None else row['n'] + 1
+
+    def update(self, config_name, n, **fields):
+        """ Changes some fields (status, ip...) of a recorded instance """
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError("Unknown registry fields: {}".format(", ".join(sorted(unknown))))
+        fields['updated_at'] = time.time()
+        names = sorted(fields)
+        with self._connect() as conn:
+            conn.execute("UPDATE instances SET {} WHERE config_name = ? AND n = ?".format(
+                ", ".join("{} = ?".format(name) for name in names)),
+                         [fields[name] for name in names] + [config_name, int(n)])
+
+    def get(self, config_name, n):
+        """ Returns instance `n` of a config as a dict, or None """
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM instances WHERE config_name = ? AND n = ?",
+                               (config_name, int(n))).fetchone()
+        return dict(row) if row is not None else None
+
+    def instances(self, config_name=None):
+        """ Returns every recorded instance (of one config, if given) as dicts,
+        ordered by config and number """
+        query = "SELECT * FROM instances"
+        params = []
+        if config_name is not None:
+            query += " WHERE config_name = ?"
+            params.append(config_name)
+        query += " ORDER BY config_name, n"
+        with self._connect() as conn:
+            return [dict(row) for row in conn.execute(query, params)]
+
+    def remove(self, config_name, n):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM instances WHERE config_name = ? AND n = ?",
+                         (config_name, int(n)))
@@ -0,0 +1,61 @@
+""" Rebuilds a code tree shipped by utils/code_sync.py from its manifest.
+
+It runs on the instance before the lab's requirements are installed, which is
+why blobs are fetched with urllib rather than boto3. Blobs are kept in a cache
+on the instance, so shipping the same tree again only downloads what changed.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import urllib.request
+from concurrent import futures
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.labbox_blobs")
+
+
+def _download(url, path):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with urllib.request.urlopen(url, timeout=60) as response, open(tmp_path, "wb") as f:
+        shutil.copyfileobj(response, f, 1024 * 1024)
+    os.replace(tmp_path, path)
+
+
+def restore(manifest_url, dest, cache_dir=DEFAULT_CACHE_DIR, workers=16):
+    """ Downloads the blobs the cache doesn't have, then writes every file in
+    the manifest under dest. Returns how many blobs were downloaded. """
+    with urllib.request.urlopen(manifest_url, timeout=60) as response:
+        files = json.loads(response.read().decode("utf-8"))['files']
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    urls = {}
+    for entry in files:
+        if not os.path.exists(os.path.join(cache_dir, entry['sha'])):
+            urls[entry['sha']] = entry['url']
+    print(">> {} files, downloading {} blobs".format(len(files), len(urls)))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda sha: _download(urls[sha], os.path.join(cache_dir, sha)), urls))
+
+    for entry in files:
+        path = os.path.join(dest, entry['path'])
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        shutil.copyfile(os.path.join(cache_dir, entry['sha']), path)
+        os.chmod(path, entry['mode'])
+    return len(urls)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("manifest_url")
+    parser.add_argument("dest")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    args = parser.parse_args(argv)
+    restore(args.manifest_url, args.dest, args.cache_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
-import boto3
 import collections
 
+from . import clients
+
 # from https://gist.github.com/steder/1498451
 SecurityGroupRule = collections.namedtuple("SecurityGroupRule", ["ip_protocol",
                                                                  "from_port",
@@ -16,7 +17,7 @@ def get_or_create_security_group(c, group_name,
     groups = c.describe_security_groups(
         Filters=[{'Name': 'group-name',
                   'Values': [group_name]}])['SecurityGroups']
-    ec2 = boto3.resource('ec2')
+    ec2 = clients.get_resource('ec2', c.meta.region_name)
     group = ec2.SecurityGroup(groups[0]['GroupId']) if groups else None
     #group = c.SecurityGroup(r['GroupId'])
     if not group:
@@ -0,0 +1,29 @@
+import os
+import sqlite3
+import contextlib
+
+
+def open_database(path):
+    """ Creates the directory of a SQLite file if needed, and switches the
+    database to WAL, so readers don't block the writer. Returns the path. """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with connect(path) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+    return path
+
+
+@contextlib.contextmanager
+def connect(path, row_factory=None):
+    """ Yields a connection of its own to a SQLite file, inside a transaction
+    that commits on success, and closes it afterwards. Waits up to 30s for
+    another connection's write lock instead of failing straight away. """
+    conn = sqlite3.connect(path, timeout=30)
+    if row_factory is not None:
+        conn.row_factory = row_factory
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()